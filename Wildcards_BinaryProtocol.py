@@ -0,0 +1,91 @@
+"""
+ Copyright (c) 2018 Dynamic Phase, LLC All rights reserved.
+
+ This program is free software; you can redistribute it and/or
+ modify it under the terms of the GNU AFFERO GENERAL PUBLIC LICENSE
+ Version 3 as published by the Free Software Foundation; either
+ or (at your option) any later version.
+ This library is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ General Public License for more details.
+
+ You should have received a copy of the GNU AFFERO GENERAL PUBLIC LICENSE
+ along with this library; if not, write to the Free Software
+ Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+"""
+
+import struct
+
+# Compact binary encoding for the most frequent websocket messages.
+#
+# A client selects it by offering the SUBPROTOCOL websocket subprotocol
+# when it connects. Only the messages below have a binary layout; they are
+# sent as binary frames that start with a one byte opcode followed by
+# little-endian fields. Everything else keeps using JSON text frames, and
+# JSON text frames are still accepted from binary clients.
+#
+#     analog_write            0x01  pin (uint8), value (uint16)
+#     digital_write           0x02  pin (uint8), value (uint8)
+#     analog_message_reply    0x81  analog pin (uint8), value (uint16)
+#     digital_message_reply   0x82  pin (uint8), value (uint8)
+
+SUBPROTOCOL = "wildcards.binary.v1"
+
+ANALOG_WRITE = 0x01
+DIGITAL_WRITE = 0x02
+ANALOG_MESSAGE_REPLY = 0x81
+DIGITAL_MESSAGE_REPLY = 0x82
+
+_ANALOG = struct.Struct("<BBH")
+_DIGITAL = struct.Struct("<BBB")
+
+# opcode -> (method name, frame layout) for frames sent by clients
+_COMMANDS = {
+    ANALOG_WRITE: ("analog_write", _ANALOG),
+    DIGITAL_WRITE: ("digital_write", _DIGITAL),
+}
+
+# method name -> (opcode, frame layout) for frames sent to clients
+_REPLIES = {
+    "analog_message_reply": (ANALOG_MESSAGE_REPLY, _ANALOG),
+    "digital_message_reply": (DIGITAL_MESSAGE_REPLY, _DIGITAL),
+}
+
+
+def decode_command(frame):
+    """
+    Decodes a binary frame received from a client
+
+    :param frame: bytes of one binary websocket frame
+    :returns: (method, params) in the same form as a decoded JSON command
+    """
+    if not frame:
+        raise ValueError("Empty binary frame")
+    try:
+        method, layout = _COMMANDS[frame[0]]
+    except KeyError:
+        raise ValueError("Unknown binary opcode 0x{:02x}".format(frame[0]))
+    if len(frame) != layout.size:
+        raise ValueError("Binary {} frame is {} bytes, expected {}".format(method, len(frame), layout.size))
+    _, pin, value = layout.unpack(frame)
+    return method, [pin, value]
+
+
+def encode_reply(method, params):
+    """
+    Encodes a reply as a binary frame, if it has a binary layout
+
+    :param method: reply method name
+    :param params: reply parameters, [PIN, VALUE]
+    :returns: the frame as bytes, or None if the reply must be sent as JSON
+    """
+    reply = _REPLIES.get(method)
+    if reply is None:
+        return None
+    opcode, layout = reply
+    try:
+        return layout.pack(opcode, params[0], params[1])
+    except struct.error:
+        # value out of range for the compact layout
+        return None
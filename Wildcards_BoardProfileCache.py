@@ -0,0 +1,129 @@
+"""
+ Copyright (c) 2018 Dynamic Phase, LLC All rights reserved.
+
+ This program is free software; you can redistribute it and/or
+ modify it under the terms of the GNU AFFERO GENERAL PUBLIC LICENSE
+ Version 3 as published by the Free Software Foundation; either
+ or (at your option) any later version.
+ This library is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ General Public License for more details.
+
+ You should have received a copy of the GNU AFFERO GENERAL PUBLIC LICENSE
+ along with this library; if not, write to the Free Software
+ Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+"""
+
+import json
+import os
+
+from Wildcards_Logger import *
+
+def default_profile_path():
+    return os.path.join(os.path.expanduser("~"), ".wildcards", "board_profiles.json")
+
+class BoardProfileCache:
+    """
+    On-disk cache of board profiles: the firmware ID, analog map, capability
+    report and derived pin table of each board that has been discovered.
+
+    Profiles are keyed by serial port and firmware ID. The cache also
+    remembers which firmware was last seen on each port, since that is
+    what a reconnect looks up before the board has been queried.
+    """
+
+    def __init__(self, path=None):
+        """
+        :param path: JSON file to keep the profiles in. Defaults to
+                     ~/.wildcards/board_profiles.json
+        """
+        self.path = path or default_profile_path()
+        self._profiles = None
+
+    def _load(self):
+        if self._profiles is None:
+            self._profiles = {}
+            try:
+                with open(self.path, 'r') as f:
+                    self._profiles = json.load(f)
+            except FileNotFoundError:
+                pass
+            except (OSError, ValueError) as ex:
+                logstring("Unable to read board profiles from {}: {}".format(self.path, ex))
+        return self._profiles
+
+    def _save(self):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'w') as f:
+                json.dump(self._profiles, f)
+            os.replace(temp_path, self.path)
+        except OSError as ex:
+            logstring("Unable to save board profiles to {}: {}".format(self.path, ex))
+
+    def lookup(self, com_port, firmware=None):
+        """
+        Retrieves a cached profile
+
+        :param com_port: serial port name
+        :param firmware: firmware ID, or None for the firmware last seen on the port
+        :returns: profile dictionary with 'firmware', 'analog_map', 'capability'
+                  and 'pins' entries, or None if there isn't one
+        """
+        port_entry = self._load().get(com_port)
+        if port_entry is None:
+            return None
+        if firmware is None:
+            firmware = port_entry.get('last')
+        return port_entry.get('boards', {}).get(firmware)
+
+    @staticmethod
+    def matches(profile, firmware, analog_map):
+        """
+        Checks a cached profile against the board on the port. The firmware ID
+        alone doesn't tell apart boards running the same sketch, such as an Uno
+        and a Mega, so the analog map, which has an entry for every pin, has to
+        match too.
+
+        :param profile: profile returned by lookup()
+        :param firmware: firmware ID reported by the board
+        :param analog_map: analog map response from the board, or None if it didn't answer
+        :returns: True if the profile describes the board
+        """
+        return (firmware == profile['firmware'] and analog_map is not None and
+                list(analog_map) == list(profile['analog_map']))
+
+    def store(self, com_port, firmware, analog_map, capability, pins):
+        """
+        Saves a profile and records it as the last one seen on the port
+
+        :param com_port: serial port name
+        :param firmware: firmware ID reported by the board
+        :param analog_map: analog map response
+        :param capability: capability report response
+        :param pins: pin table derived from the two reports
+        """
+        port_entry = self._load().setdefault(com_port, {'last': None, 'boards': {}})
+        port_entry['boards'][firmware] = {'firmware': firmware,
+                                          'analog_map': list(analog_map),
+                                          'capability': list(capability),
+                                          'pins': pins}
+        port_entry['last'] = firmware
+        self._save()
+
+    def invalidate(self, com_port, firmware):
+        """
+        Removes a profile that turned out not to match the board
+
+        :param com_port: serial port name
+        :param firmware: firmware ID of the profile to remove
+        """
+        port_entry = self._load().get(com_port)
+        if port_entry is None:
+            return
+        port_entry.get('boards', {}).pop(firmware, None)
+        if port_entry.get('last') == firmware:
+            port_entry['last'] = None
+        self._save()
@@ -0,0 +1,324 @@
+"""
+ Copyright (c) 2018 Dynamic Phase, LLC All rights reserved.
+
+ This program is free software; you can redistribute it and/or
+ modify it under the terms of the GNU AFFERO GENERAL PUBLIC LICENSE
+ Version 3 as published by the Free Software Foundation; either
+ or (at your option) any later version.
+ This library is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ General Public License for more details.
+
+ You should have received a copy of the GNU AFFERO GENERAL PUBLIC LICENSE
+ along with this library; if not, write to the Free Software
+ Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+"""
+
+import asyncio
+import collections
+import json
+import time
+import websockets
+
+from Wildcards_Logger import *
+import Wildcards_Metrics as Metrics
+
+class SubscriptionFilter:
+    """
+    Thins out the sensor updates of one subscription, before they are encoded.
+
+    An update whose value is within the deadband of the last value sent is
+    skipped. Updates arriving faster than max_rate are held back, keeping only
+    the latest, and that one is handed to release when its turn comes, so the
+    client always ends up with the current value.
+    """
+
+    def __init__(self, release, max_rate=0, deadband=0, deadband_percent=0):
+        """
+        :param release: called with (method, params) to send a held back update
+        :param max_rate: maximum updates per second, 0 for no limit
+        :param deadband: minimum absolute change from the last value sent
+        :param deadband_percent: minimum change from the last value sent, in
+                                 percent of that value
+        """
+        self._release = release
+        self.min_interval = 1 / max_rate if max_rate > 0 else 0
+        self.deadband = deadband
+        self.deadband_percent = deadband_percent
+        self.last_sent_time = None
+        self.last_sent_value = None
+        self._held = None
+        self._held_handle = None
+
+    def _outside_deadband(self, value):
+        if self.last_sent_value is None or value is None:
+            return True
+        try:
+            change = abs(value - self.last_sent_value)
+        except TypeError:
+            # not a number; only repeats of the same value are filtered
+            return value != self.last_sent_value
+        if change <= self.deadband:
+            return False
+        if change * 100 <= abs(self.last_sent_value) * self.deadband_percent:
+            return False
+        return True
+
+    def offer(self, method, params, now):
+        """
+        Decides what happens to an update
+
+        :param method: reply method name
+        :param params: reply parameters; the value is the last parameter
+        :param now: time.monotonic() of the update
+        :returns: True if the update should be sent right away
+        """
+        value = params[-1] if isinstance(params, list) else params
+        if not self._outside_deadband(value):
+            # the client's view is still current; anything held is out of date
+            self._held = None
+            return False
+        if self.last_sent_time is not None and now - self.last_sent_time < self.min_interval:
+            self._held = (method, params)
+            if self._held_handle is None:
+                loop = asyncio.get_event_loop()
+                delay = self.last_sent_time + self.min_interval - now
+                self._held_handle = loop.call_later(delay, self._release_held)
+            return False
+        self._sent(value, now)
+        return True
+
+    def _sent(self, value, now):
+        self.last_sent_time = now
+        self.last_sent_value = value
+
+    def _release_held(self):
+        self._held_handle = None
+        if self._held is None:
+            return
+        method, params = self._held
+        self._held = None
+        self._sent(params[-1] if isinstance(params, list) else params, time.monotonic())
+        self._release(method, params)
+
+    def cancel(self):
+        if self._held_handle is not None:
+            self._held_handle.cancel()
+            self._held_handle = None
+        self._held = None
+
+
+class ClientSession:
+    """
+    This class holds the state of one websocket connection to WildServer.
+    Replies to a client's requests go to its own session, and
+    notifications go to the sessions subscribed to them.
+
+    Everything sent to the client passes through a bounded outbound queue
+    that a single writer task drains, so a slow client can't pile up
+    unbounded pending sends. When the queue is full, the oldest sensor
+    update is dropped to make room. A sensor update that is still waiting
+    in the queue is replaced by a newer one for the same pin. Replies and
+    other messages that aren't marked droppable are always kept.
+    """
+
+    def __init__(self, websocket, session_id, max_queue=256, binary=False):
+        """
+        :param websocket: the connection this session belongs to
+        :param session_id: number identifying the session in log output
+        :param max_queue: number of queued messages above which sensor updates are dropped
+        :param binary: the client negotiated the binary subprotocol
+        """
+        self.websocket = websocket
+        self.session_id = session_id
+        self.binary = binary
+        self.closed = False
+        # maps each (kind, key) pair this client receives notifications for
+        # to its SubscriptionFilter, or None when every update is wanted
+        self.subscriptions = {}
+        # batching window in seconds; 0 sends each notification in its own frame
+        self.batch_window = 0
+        # latest params per (kind, key), in order of first arrival in the window
+        self._batch = {}
+        self._batch_handle = None
+
+        self.max_queue = max_queue
+        # queued entries are [droppable, key, message, method] lists
+        self._queue = collections.deque()
+        # entries still waiting in _queue, by the key of the sensor update they carry
+        self._queued_keys = {}
+        self._queue_ready = asyncio.Event()
+        self.max_queue_depth = 0
+        self.sent_messages = 0
+        self.dropped_messages = 0
+        self.superseded_messages = 0
+        self._writer_task = asyncio.ensure_future(self._writer())
+        # commands from this client that are running as separate tasks
+        self._tasks = set()
+
+    def __repr__(self):
+        return "ClientSession {}".format(self.session_id)
+
+    @property
+    def queue_depth(self):
+        return len(self._queue)
+
+    def get_stats(self):
+        """
+        :returns: dictionary of outbound queue counters for this client
+        """
+        return {"session": self.session_id,
+                "queue_depth": len(self._queue),
+                "max_queue_depth": self.max_queue_depth,
+                "sent": self.sent_messages,
+                "dropped": self.dropped_messages,
+                "superseded": self.superseded_messages}
+
+    def _enqueue(self, message, droppable, key, method):
+        if self.closed:
+            return
+        if key is not None:
+            entry = self._queued_keys.get(key)
+            if entry is not None:
+                # latest value wins: the client hasn't seen the older one yet
+                entry[2] = message
+                entry[3] = method
+                self.superseded_messages += 1
+                return
+        if droppable and len(self._queue) >= self.max_queue:
+            if not self._drop_oldest():
+                # the queue holds nothing but messages that must be kept
+                self.dropped_messages += 1
+                return
+        entry = [droppable, key, message, method]
+        self._queue.append(entry)
+        if key is not None:
+            self._queued_keys[key] = entry
+        if len(self._queue) > self.max_queue_depth:
+            self.max_queue_depth = len(self._queue)
+        self._queue_ready.set()
+
+    def _drop_oldest(self):
+        for entry in self._queue:
+            if entry[0]:
+                self._queue.remove(entry)
+                if entry[1] is not None:
+                    del self._queued_keys[entry[1]]
+                self.dropped_messages += 1
+                return True
+        return False
+
+    async def _writer(self):
+        """
+        Sends queued messages to the client one at a time, in order
+        """
+        while not self.closed:
+            if not self._queue:
+                self._queue_ready.clear()
+                await self._queue_ready.wait()
+                continue
+            entry = self._queue.popleft()
+            key = entry[1]
+            if key is not None and self._queued_keys.get(key) is entry:
+                del self._queued_keys[key]
+            try:
+                await self.websocket.send(entry[2])
+            except websockets.exceptions.ConnectionClosed:
+                self.close()
+                return
+            self.sent_messages += 1
+            if entry[3] is not None:
+                Metrics.WEBSOCKET_MESSAGES_OUT.labels(entry[3]).inc()
+
+    async def send(self, message, method=None):
+        """
+        Queues a reply for this client. Replies are never dropped.
+
+        :param message: encoded message
+        :param method: method of the message, for the outgoing message metric
+        """
+        self._enqueue(message, False, None, method)
+
+    def send_soon(self, message, droppable=False, key=None, method=None):
+        """
+        Queues a message for this client without waiting for it
+
+        :param message: encoded message
+        :param method: method of the message, for the outgoing message metric
+        :param droppable: the message may be dropped when the queue is full
+        :param key: for sensor updates, the (kind, key) subscription the update
+                    belongs to. A queued update with the same key is replaced
+                    rather than a second one being queued. Implies droppable
+        """
+        self._enqueue(message, droppable or key is not None, key, method)
+
+    def start_task(self, coro):
+        """
+        Runs a command handler as a separate task, so this client's next
+        commands can be handled while it waits. The task is cancelled if
+        the connection closes first.
+
+        :param coro: command handler coroutine
+        """
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._task_done)
+
+    def _task_done(self, task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logerr("{}: command failed: {!r}".format(self, task.exception()))
+
+    def set_batch_window(self, window):
+        """
+        Turns notification batching on or off. Anything already gathered
+        is sent right away when batching is turned off.
+
+        :param window: batching window in seconds, 0 to disable
+        """
+        self.batch_window = window
+        if not window:
+            self.flush_batch()
+
+    def add_to_batch(self, key, method, params):
+        """
+        Holds a notification until the end of the current batching window.
+        A later notification with the same key replaces the held one.
+
+        :param key: (kind, key) subscription the notification belongs to
+        :param method: reply method name
+        :param params: reply parameters
+        """
+        if self.closed:
+            return
+        self._batch[key] = (method, params)
+        if self._batch_handle is None:
+            loop = asyncio.get_event_loop()
+            self._batch_handle = loop.call_later(self.batch_window, self.flush_batch)
+
+    def flush_batch(self):
+        """
+        Sends everything gathered in the current window as one batch_reply frame
+        """
+        if self._batch_handle is not None:
+            self._batch_handle.cancel()
+            self._batch_handle = None
+        if not self._batch:
+            return
+        entries = [[method, params] for method, params in self._batch.values()]
+        self._batch = {}
+        self.send_soon(json.dumps({"method": "batch_reply", "params": entries}), droppable=True,
+                       method="batch_reply")
+
+    def close(self):
+        self.closed = True
+        for task in self._tasks:
+            task.cancel()
+        self._queue.clear()
+        self._queued_keys = {}
+        self._queue_ready.set()
+        if self._batch_handle is not None:
+            self._batch_handle.cancel()
+            self._batch_handle = None
+        self._batch = {}
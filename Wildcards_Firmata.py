@@ -26,6 +26,7 @@ import decimal
 import math
 import serial
 import inspect
+import collections
 
 from constants import Constants
 from pin_data import PinData
@@ -36,6 +37,9 @@ from Wildcards_Pin import Pin
 from Wildcards_Port import Port
 from Wildcards_Tone import Tone
 from Wildcards_KeepAlive import KeepAlive
+from Wildcards_FirmataParser import FirmataParser
+import Wildcards_Metrics as Metrics
+import Wildcards_Tracing as Tracing
 
 from Wildcards_Logger import *
 #from Wildcards_I2C import I2C
@@ -50,7 +54,8 @@ class WildcardsFirmata(WildcardsFirmataBaseObject):
     perform Arduino pin auto-detection.
     """
 
-    def __init__(self, parent=None, arduino_wait=2, sleep_tune=0.001, baud_rate=57600):
+    def __init__(self, parent=None, arduino_wait=2, sleep_tune=0.001, baud_rate=57600,
+                 dispatch_batch_size=64, board_profiles=None):
         super().__init__("WildCardsFirmata")
 
         """
@@ -61,14 +66,19 @@ class WildcardsFirmata(WildcardsFirmataBaseObject):
         will be written to the log.
 
 
-        :param arduino_wait: Amount of time to wait for Arduino to reset.
-                             UNO takes 2 seconds, Leonardo can be zero
+        :param arduino_wait: Longest time to allow for the Arduino to reset.
+                             UNO takes 2 seconds, Leonardo can be zero.
+                             Setup continues as soon as the board answers
         :param sleep_tune: This parameter sets the amount of time to default
                            for asyncio.sleep
         :param com_port: Manually selected com port - normally it is
                          auto-detected
         :param baud_rate: This parameter sets the bit rate for comms with Firmata
                            over the serial port
+        :param dispatch_batch_size: Maximum number of received messages handled
+                                    before the dispatcher yields to other tasks
+        :param board_profiles: BoardProfileCache used to speed up reconnects,
+                               or None to always discover the board
 
         :returns: This method never returns
         """
@@ -82,6 +92,7 @@ class WildcardsFirmata(WildcardsFirmataBaseObject):
 
         self.sleep_tune = sleep_tune
         self.arduino_wait = arduino_wait
+        self.dispatch_batch_size = dispatch_batch_size
 
         self.hall_encoder = False
 
@@ -131,6 +142,37 @@ class WildcardsFirmata(WildcardsFirmataBaseObject):
         self.serial_port = None
         self.serial_manager = None
 
+        # turns the raw bytes in the serial ReadBuffer into complete messages
+        self._parser = FirmataParser()
+        # parsed messages waiting to be handled by the command dispatcher
+        self._pending_messages = collections.deque()
+
+        # queries sent to Firmata that are waiting for a reply. The key
+        # identifies the reply (e.g. REPORT_FIRMWARE, or
+        # (PIN_STATE_RESPONSE, pin)) and the value is the asyncio.Future the
+        # matching message handler resolves. Callers asking the same question
+        # while a query is in flight share its future.
+        self._pending_queries = {}
+        # future -> number of callers still waiting on it
+        self._query_waiters = {}
+
+        # top level objects (ports, keepalive, tone) with something to write,
+        # and the event that wakes write_continuously when that set is not empty
+        self._dirty_objects = set()
+        self._output_ready = asyncio.Event()
+        # while greater than zero, write_continuously leaves dirty objects queued
+        # so that a group of updates goes out together (see hold_output)
+        self._output_hold = 0
+        # callables run by write_continuously just before it collects the dirty
+        # objects, so that writes buffered elsewhere make it into the frame
+        self._pre_flush_hooks = []
+        # set once the board on the current port has answered a firmware query
+        self._board_verified = False
+
+        # remembers the pin layout of boards seen before, so that reconnects
+        # can skip the analog map and capability queries
+        self.board_profiles = board_profiles
+
         self.keep_alive_interval = 0
         self.period = 0
         self.margin = 0
@@ -143,6 +185,79 @@ class WildcardsFirmata(WildcardsFirmataBaseObject):
     def generate_byte_string(self):
         return super().generate_byte_string()
 
+    def _object_dirty(self, firmata_object):
+        """
+        This is a private utility method.
+        Dirty listener for the top level objects: queues the object for the
+        next write and wakes write_continuously
+
+        :param firmata_object: the object with something to write
+        :returns: No return value
+        """
+        self._dirty_objects.add(firmata_object)
+        self._output_ready.set()
+
+    def hold_output(self):
+        """
+        Keeps everything marked dirty from being written until the matching
+        release_output(), so that updates to several pins are sent to the
+        board in the same frame. Calls may be nested.
+
+        :returns: No return value
+        """
+        self._output_hold += 1
+
+    def release_output(self):
+        """
+        Ends a hold_output() and writes anything that was queued during it.
+
+        :returns: No return value
+        """
+        if self._output_hold > 0:
+            self._output_hold -= 1
+        if self._output_hold == 0:
+            self._output_ready.set()
+
+    def output_pending(self):
+        """
+        :returns: True if there are pin updates waiting for write_continuously
+        """
+        return bool(self._dirty_objects)
+
+    def add_pre_flush_hook(self, hook):
+        """
+        Registers a callable that write_continuously runs right before it
+        builds each frame. The hook may call analog_write, digital_write etc.
+        and those updates are included in the frame.
+
+        :param hook: callable taking no arguments
+        :returns: No return value
+        """
+        self._pre_flush_hooks.append(hook)
+
+    def request_flush(self):
+        """
+        Wakes write_continuously so that the pre flush hooks run, for callers
+        that buffer their writes instead of applying them right away.
+
+        :returns: No return value
+        """
+        self._output_ready.set()
+
+    def _generate_dirty_byte_string(self):
+        """
+        This is a private utility method.
+        Creates the byte string for only those objects that reported
+        themselves dirty, in the same order generate_byte_string uses
+
+        :returns: bytes to write
+        """
+        dirty = self._dirty_objects
+        if not dirty:
+            return b""
+        self._dirty_objects = set()
+        return b"".join([x.generate_byte_string() for x in self._nested_objects if x in dirty])
+
     def _clear_stored_response_dictionaries(self):
         logstring("Clearing all responses")
         # report query results are stored in this dictionary
@@ -168,6 +283,10 @@ class WildcardsFirmata(WildcardsFirmataBaseObject):
         #   pin: [callback, [current_data_returned]]
         self.active_sonar_map = {}
 
+        # maps encoder pin A to pin B for every configured encoder. The
+        # encoder value is kept in digital_pins[pin A]
+        self.active_encoder_map = {}
+
         # The latch_map is a dictionary that stores all latches setup by
         # the user.
         # The key is a string defined as follows:
@@ -234,10 +353,10 @@ class WildcardsFirmata(WildcardsFirmataBaseObject):
 
     def remove_serial_port(self):
         self._valid_target_exists = False
+        #nothing is going to answer outstanding queries now
+        self._fail_pending_queries()
         #self.serial_port = None
 
-        #clear ReadBuffer here too?
-
     async def assign_serial_port(self, serial_manager):
         """
         This method is called any time a new serial port is assumed to have
@@ -267,6 +386,12 @@ class WildcardsFirmata(WildcardsFirmataBaseObject):
         self.read = self.serial_manager.CurrentPort.read
         self.write = self.serial_manager.CurrentPort.write
 
+        # discard anything left over from a previous connection; the handshake
+        # below asks the new board for what it needs
+        self.serial_manager.ReadBuffer.clear()
+        self._parser.reset()
+        self._pending_messages.clear()
+
         self._valid_target_exists = True
 
 
@@ -277,21 +402,37 @@ class WildcardsFirmata(WildcardsFirmataBaseObject):
         #and ports
         self._ports_directly = []
 
-        # wait for arduino to go through a reset cycle if need be
-        logstring("Waiting for 2 seconds...")
-        time.sleep(self.arduino_wait)
-        #logstring("time is up!")
-        #await asyncio.sleep(self.arduino_wait)
+        #anything still queued belongs to the previous board's objects
+        self._dirty_objects = set()
 
         # register the get_command method with the event loop
         self.loop = asyncio.get_event_loop()
 
-        logstring("Setting up Firmata on port {}".format(self.serial_port.com_port))
+        logstring("Setting up Firmata on port {}".format(self.serial_port.com_port), subsystem="discovery")
+
+        # nothing is written to the board until it has answered a firmware query
+        self._board_verified = False
+
+        # a board seen on this port before can be set up from the cached profile
+        # right away, and checked against a firmware query in the background
+        profile = None
+        if self.board_profiles is not None:
+            profile = self.board_profiles.lookup(self.serial_port_name)
+        if profile is not None:
+            logstring("Using cached board profile for {} ({})".format(self.serial_port_name,
+                                                                      profile['firmware']),
+                      subsystem="discovery")
+            self.query_reply_data[PrivateConstants.ANALOG_MAPPING_RESPONSE] = profile['analog_map']
+            self.query_reply_data[PrivateConstants.CAPABILITY_RESPONSE] = profile['capability']
+            self._build_pin_tree(profile['pins'])
+            self.loop.create_task(self._verify_board_profile(self.serial_port, profile))
+            return
 
-        # get arduino firmware version and print it
-        logstring("Checking Firmware version")
-        firmware_version = await self.get_firmware_version()
-        logstring("Finished checking Firmware version")
+        # get arduino firmware version and print it. This also covers
+        # waiting for the arduino to go through a reset cycle if need be
+        logstring("Checking Firmware version", subsystem="discovery")
+        firmware_version = await self._handshake()
+        logstring("Finished checking Firmware version", subsystem="discovery")
         if not firmware_version:
             logerr('*** Firmware Version retrieval timed out. ***')
             logerr('Firmata not found')
@@ -305,13 +446,26 @@ class WildcardsFirmata(WildcardsFirmataBaseObject):
             except TypeError:
                 self.disconnect_port_due_to_error()
                 return
-        logstring("\nFirmware ID: " + firmware_version)
-        logstring("On port {}".format(self.serial_port_name))
+        logstring("\nFirmware ID: " + firmware_version, subsystem="discovery")
+        logstring("On port {}".format(self.serial_port_name), subsystem="discovery")
+        self._mark_board_verified()
+
+        await self._discover_board(firmware_version)
+
+    async def _discover_board(self, firmware_version):
+        """
+        This is a private method.
+        Retrieves the analog map and capability report, builds the pin tree
+        from them, and saves the result as the board profile for this port
+
+        :param firmware_version: firmware ID the board reported
+        :returns: No return value.
+        """
         # get an analog pin map
 
         # try to get an analog report. if it comes back as none - shutdown
         # report = await self.get_analog_map()
-        logstring("Fetching analog mapping")
+        logstring("Fetching analog mapping", subsystem="discovery")
         analogreport = await self.get_analog_map()
         #logstring("got analog map")
         if not analogreport:
@@ -342,26 +496,83 @@ class WildcardsFirmata(WildcardsFirmataBaseObject):
             except TypeError:
                 self.disconnect_port_due_to_error()
                 return
-        # custom assemble the pin lists
-        pininfo = iter(capabilityreport)
 
+        pin_table = self._parse_pin_table(analogreport, capabilityreport)
+        self._build_pin_tree(pin_table)
 
-        self._nested_objects = []
+        if self.board_profiles is not None:
+            self.board_profiles.store(self.serial_port_name, firmware_version,
+                                      analogreport, capabilityreport, pin_table)
+
+    async def _verify_board_profile(self, serial_port, profile):
+        """
+        This is a private method.
+        Confirms that the board on the port is the one a cached profile was
+        built for, by its firmware and its analog map. If either differs, the
+        profile is dropped and the board is discovered from scratch.
+
+        :param serial_port: the port the profile was applied to
+        :param profile: the cached board profile
+        :returns: No return value.
+        """
+        firmware_version = await self._handshake()
+        if self.serial_port is not serial_port or not self._valid_target_exists:
+            return  #the port changed while we were waiting
+        if not firmware_version:
+            logerr('*** Firmware Version retrieval timed out. ***')
+            logerr('Firmata not found')
+            self.disconnect_port_due_to_error()
+            return
+        logstring("\nFirmware ID: " + firmware_version, subsystem="discovery")
+        logstring("On port {}".format(self.serial_port_name), subsystem="discovery")
+        analog_map = None
+        if firmware_version == profile['firmware']:
+            # the same sketch runs on many boards; the analog map tells them apart.
+            # query it directly, since get_analog_map would return the cached one
+            analog_map = await self._query(PrivateConstants.ANALOG_MAPPING_RESPONSE,
+                                           lambda: self._send_sysex(PrivateConstants.ANALOG_MAPPING_QUERY, None),
+                                           timeout=3)
+            if self.serial_port is not serial_port or not self._valid_target_exists:
+                return
+            if self.board_profiles.matches(profile, firmware_version, analog_map):
+                self._mark_board_verified()
+                return
+
+        logstring("Cached board profile does not match; rediscovering the board", subsystem="discovery")
+        self.board_profiles.invalidate(self.serial_port_name, profile['firmware'])
+        # a fresh analog map is kept, so discovery doesn't ask for it again
+        self.query_reply_data[PrivateConstants.ANALOG_MAPPING_RESPONSE] = analog_map
+        self.query_reply_data[PrivateConstants.CAPABILITY_RESPONSE] = None
+        #whatever was queued for the cached pin tree doesn't apply to this board
+        self._dirty_objects = set()
+        self._mark_board_verified()
+        await self._discover_board(firmware_version)
+
+    def _mark_board_verified(self):
+        """
+        This is a private utility method.
+        Allows output to be written now that the board has answered, and
+        flushes anything that was queued in the meantime.
+        """
+        self._board_verified = True
+        self._output_ready.set()
 
+    def _parse_pin_table(self, analogreport, capabilityreport):
+        """
+        This is a private utility method.
+        Derives the capabilities of each pin from the analog map and
+        capability report
+
+        :param analogreport: analog map response
+        :param capabilityreport: capability report response
+        :returns: a list with one dictionary of Pin keyword arguments per pin
+        """
+        # custom assemble the pin lists
+        pininfo = iter(capabilityreport)
+        pin_table = []
 
         for i, analogpinmapping in enumerate(analogreport):
-            #set up the data structure that captures data that comes from Firmata
-            digital_data = PinData()
-            self.digital_pins.append(digital_data)
-            HasAnalog = False
-            analog_data = PinData()
-            self.analog_pins.append(analog_data)
-            if analogpinmapping != Constants.IGNORE:
-                self.analog_pins_analog_numbering.append(analog_data)
-                HasAnalog = True
-            #set up the data structure that captures data to be sent to Firmata
-            port_num = math.floor(i/8)
-            pin_num_within_port = i%8
+            HasAnalog = analogpinmapping != Constants.IGNORE
             HasInput = False
             HasOutput = False
             HasPullup = False
@@ -386,7 +597,7 @@ class WildcardsFirmata(WildcardsFirmataBaseObject):
                         AnalogResolution = resolutionbyte
                         AnalogPinNum = analogpinmapping
                     if nextbyte == Constants.PWM:
-                        HasPWM = True,
+                        HasPWM = True
                         PWMResolution=14
                     if nextbyte == Constants.SERVO:
                         pass
@@ -403,23 +614,59 @@ class WildcardsFirmata(WildcardsFirmataBaseObject):
                 #this really shouldn't happen, but might as well catch it anyway
                 raise Exception("The Analog Pin Map disagrees with the Capabilty Report as to whether pin {} is an analog pin".format(i))
 
+            pin_table.append({'HasInput': HasInput, 'HasPullup': HasPullup,
+                              'HasOutput': HasOutput, 'HasAnalog': HasAnalog,
+                              'AnalogPinNum': analogpinmapping,
+                              'AnalogResolution': AnalogResolution, 'HasPWM': HasPWM,
+                              'PWMResolution': PWMResolution, 'HasI2C': HasI2C})
+        return pin_table
+
+    def _build_pin_tree(self, pin_table):
+        """
+        This is a private utility method.
+        Creates the PinData, Pin and Port objects (plus KeepAlive and Tone)
+        for a board described by pin_table
+
+        :param pin_table: list of Pin keyword arguments, as made by _parse_pin_table
+        :returns: No return value.
+        """
+        self.analog_pins = []
+        self.analog_pins_analog_numbering = []
+        self.digital_pins = []
+        self._digital_pins_directly = []
+        self._analog_pins_directly = []
+        self._ports_directly = []
+        self._dirty_objects = set()
+        self._nested_objects = []
+
+        for i, pin_info in enumerate(pin_table):
+            HasAnalog = pin_info['HasAnalog']
+            #set up the data structure that captures data that comes from Firmata
+            digital_data = PinData()
+            self.digital_pins.append(digital_data)
+            analog_data = PinData()
+            self.analog_pins.append(analog_data)
+            if HasAnalog:
+                self.analog_pins_analog_numbering.append(analog_data)
+            #set up the data structure that captures data to be sent to Firmata
+            port_num = math.floor(i/8)
+            pin_num_within_port = i%8
+
             #this sets the pin number 0-7 within each port
             if pin_num_within_port == 0: #Yay, new port, create it:
                 current_port = Port("Port {}".format(port_num),
                                                    port_num)
+                current_port.set_dirty_listener(self._object_dirty)
                 self._nested_objects.append(current_port)
                 self._ports_directly.append(current_port)
 
             newpin = Pin(ID = "Pin {} of Port {} hasanalog = {}".format(pin_num_within_port,
                                                                        port_num, HasAnalog),
-                                       PinNum = i, HasInput=HasInput,
-                                       HasPullup=HasPullup, HasOutput=HasOutput,
-                                       HasAnalog=HasAnalog, AnalogPinNum=analogpinmapping,
-                                       AnalogResolution=AnalogResolution, HasPWM=HasPWM,
-                                       PWMResolution=PWMResolution, HasI2C=HasI2C)
-            current_port.pins.append(newpin)
+                                       PinNum = i, **pin_info)
+            current_port.add_pin(newpin)
             self._digital_pins_directly.append(newpin)
-            logstring("Appending a new pin {}   len {}".format(newpin._ID, len(self._digital_pins_directly)))
+            logdebug("Appending a new pin {}   len {}", newpin._ID, len(self._digital_pins_directly),
+                     subsystem="discovery")
             if HasAnalog:
                 self._analog_pins_directly.append(newpin)
 
@@ -427,22 +674,50 @@ class WildcardsFirmata(WildcardsFirmataBaseObject):
 
         logstring('Auto-discovery complete. Found ' + \
                  str(len(self.digital_pins)) + ' Digital Pins and ' + \
-                 str(len(self.analog_pins_analog_numbering)) + ' Analog Pins')
+                 str(len(self.analog_pins_analog_numbering)) + ' Analog Pins', subsystem="discovery")
 
         self._numpins = len(self.digital_pins)
         self._numports = math.ceil(self._numpins/8)
 
 
         self.KeepAlive = KeepAlive("Keep Alive")
+        self.KeepAlive.set_dirty_listener(self._object_dirty)
         self._nested_objects.append(self.KeepAlive)
 
         self.Tone = Tone("Tone", self._numpins)
+        self.Tone.set_dirty_listener(self._object_dirty)
         self._nested_objects.append(self.Tone)
 
         #self.EncoderConfig = EncoderConfig("Encoder Config", self._numpins)
         #self._nested_objects.append(self.EncoderConfig)
 
 
+    async def _handshake(self, first_timeout=0.05, max_timeout=0.5, reply_timeout=3):
+        """
+        This is a private method.
+        Queries the firmware version repeatedly, with a growing timeout per
+        attempt, until the board answers. Boards that reset when the port
+        is opened (e.g. UNO) ignore the first queries while the bootloader
+        runs; boards that don't (e.g. Leonardo) answer the first one. The
+        event loop keeps running the whole time.
+
+        :param first_timeout: seconds to wait for a reply to the first query
+        :param max_timeout: upper bound on the wait for any one query
+        :param reply_timeout: seconds to keep trying beyond arduino_wait
+        :returns: Firmata firmware version, or None if the board never answered
+        """
+        deadline = time.perf_counter() + self.arduino_wait + reply_timeout
+        timeout = first_timeout
+        while self._valid_target_exists and self.serial_port.IsPortOpen:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            firmware_version = await self.get_firmware_version(min(timeout, remaining))
+            if firmware_version:
+                return firmware_version
+            timeout = min(timeout * 2, max_timeout)
+        return None
+
     def AssignSerialPort(self, port):
         self.SerialPort = port
 
@@ -455,6 +730,21 @@ class WildcardsFirmata(WildcardsFirmataBaseObject):
         """
         return self.analog_pins_analog_numbering[pin].current_value
 
+    def analog_pin_number(self, pin):
+        """
+        Translates a digital pin number to the analog pin number used in
+        analog message reports.
+
+        :param pin: Digital pin number
+        :returns: Analog pin number (ex. 2 for A2), or None if the pin isn't analog
+        """
+        if pin >= len(self._digital_pins_directly):
+            return None
+        analog_pin = self._digital_pins_directly[pin].AnalogPinNum
+        if analog_pin == Constants.IGNORE:
+            return None
+        return analog_pin
+
     def analog_write(self, pin, value):
         """
         Set the selected pin to the specified value. This will use ANALOG_MESSAGE if possible,
@@ -557,6 +847,7 @@ class WildcardsFirmata(WildcardsFirmataBaseObject):
         data = [pin_a, pin_b]
         if cb:
             self.digital_pins[pin_a].cb = cb
+        self.active_encoder_map[pin_a] = pin_b
 
         await self._send_sysex(PrivateConstants.ENCODER_CONFIG, data)
 
@@ -621,44 +912,36 @@ class WildcardsFirmata(WildcardsFirmataBaseObject):
         else:
             return None
 
-    async def get_analog_map(self):
+    async def get_analog_map(self, timeout=10):
         """
         This method requests a Firmata analog map query and returns the results.
 
+        :param timeout: seconds to wait for the reply
         :returns: An analog map response or None if a timeout occurs
         """
-        # get the current time to make sure a report is retrieved
-        current_time = time.time()
-
         # if we do not have existing report results, send a Firmata
         # message to request one
         if self.query_reply_data.get(
                 PrivateConstants.ANALOG_MAPPING_RESPONSE) is None:
             logstring("Requesting analog mapping")
-            await self._send_sysex(PrivateConstants.ANALOG_MAPPING_QUERY, None)
-            # wait for the report results to return for 2 seconds
-            # if the timer expires, leave empty handed
-            while self.query_reply_data.get(
-                    PrivateConstants.ANALOG_MAPPING_RESPONSE) is None:
-                elapsed_time = time.time()
-                if elapsed_time - current_time > 10:
-                    return None
-                await asyncio.sleep(self.sleep_tune)
+            await self._query(PrivateConstants.ANALOG_MAPPING_RESPONSE,
+                              lambda: self._send_sysex(PrivateConstants.ANALOG_MAPPING_QUERY, None),
+                              timeout)
         return self.query_reply_data.get(
             PrivateConstants.ANALOG_MAPPING_RESPONSE)
 
-    async def get_capability_report(self):
+    async def get_capability_report(self, timeout=10):
         """
         This method requests and returns a Firmata capability query report
 
-        :returns: A capability report in the form of a list
+        :param timeout: seconds to wait for the reply
+        :returns: A capability report in the form of a list, or None if a timeout occurs
         """
         if self.query_reply_data.get(
-                PrivateConstants.CAPABILITY_QUERY) is None:
-            await self._send_sysex(PrivateConstants.CAPABILITY_QUERY, None)
-            while self.query_reply_data.get(
-                    PrivateConstants.CAPABILITY_RESPONSE) is None:
-                await asyncio.sleep(self.sleep_tune)
+                PrivateConstants.CAPABILITY_RESPONSE) is None:
+            await self._query(PrivateConstants.CAPABILITY_RESPONSE,
+                              lambda: self._send_sysex(PrivateConstants.CAPABILITY_QUERY, None),
+                              timeout)
         return self.query_reply_data.get(PrivateConstants.CAPABILITY_RESPONSE)
 
     async def get_digital_latch_data(self, pin):
@@ -678,81 +961,87 @@ class WildcardsFirmata(WildcardsFirmataBaseObject):
         else:
             return None
 
-    async def get_firmware_version(self):
+    def get_snapshot(self):
+        """
+        Collects the cached state of the board without any serial traffic.
+
+        :returns: dictionary with
+                  "pins": [{"pin": PIN, "mode": MODE, "value": LAST_REPORTED_VALUE,
+                  "output": LAST_WRITTEN_VALUE}, ...] for every digital pin,
+                  "analog": [VALUE, ...] indexed by analog pin number,
+                  "latches": {"A3" / "D5": [LATCH_STATE, THRESHOLD_TYPE, THRESHOLD_VALUE,
+                  DATA_VALUE, TIME_STAMP]},
+                  "sonar": [[TRIGGER_PIN, DISTANCE], ...],
+                  "encoders": [[PIN_A, VALUE], ...] and
+                  "i2c": [[ADDRESS, LAST_VALUE], ...]
+        """
+        pins = []
+        for i, pin in enumerate(self._digital_pins_directly):
+            pins.append({"pin": i,
+                         "mode": pin.mode,
+                         "value": self.digital_pins[i].current_value,
+                         "output": pin.value})
+        return {"pins": pins,
+                "analog": [pin.current_value for pin in self.analog_pins_analog_numbering],
+                # the last entry of a latch is its callback
+                "latches": {key: entry[:-1] for key, entry in self.latch_map.items()},
+                "sonar": [[trigger_pin, entry[1]] for trigger_pin, entry in self.active_sonar_map.items()],
+                "encoders": [[pin_a, self.digital_pins[pin_a].current_value]
+                             for pin_a in self.active_encoder_map if pin_a < len(self.digital_pins)],
+                "i2c": [[address, entry['value']] for address, entry in self.i2c_map.items()]}
+
+    async def get_firmware_version(self, timeout=3):
         """
         This method retrieves the Firmata firmware version
 
-        :returns: Firmata firmware version
+        :param timeout: seconds to wait for the reply
+        :returns: Firmata firmware version, or None if a timeout occurs
         """
-        current_time = time.time()
-        #logstring("setting current time {}".format(current_time))
-        #logstring("1")
         if self.query_reply_data.get(PrivateConstants.REPORT_FIRMWARE) == '':
-            #logstring("2")
-            #logstring("checking time now 1 {}".format(time.time()))
-            await self._send_sysex(PrivateConstants.REPORT_FIRMWARE, None)
-            #logstring("checking time now 2 {}".format(time.time()))
-            #logstring("3")
-            if self.serial_port.IsPortOpen == False:
-                #logstring("Looks like that port wasn't working!!!!!!!!!!!!!????")
+            if self.serial_port is None or self.serial_port.IsPortOpen == False:
+                return None
+            reply = await self._query(PrivateConstants.REPORT_FIRMWARE,
+                                      lambda: self._send_sysex(PrivateConstants.REPORT_FIRMWARE, None),
+                                      timeout)
+            if not reply:
                 return None
-            while self.query_reply_data.get(
-                    PrivateConstants.REPORT_FIRMWARE) == '':
-                #logstring("4")
-                elapsed_time = time.time()
-                #logstring("setting elapsed time {}".format(elapsed_time))
-                #logstring("5")
-                if elapsed_time - current_time > 3:
-                    #logstring("really took too long:  {}  {}   {}".format(elapsed_time, current_time, elapsed_time - current_time))
-                    return None
-                #logstring("7")
-                if self.serial_port.IsPortOpen == False:
-                    #logstring("Looks like that port wasn't working!!!!!!!!!!!!!")
-                    return None
-                await asyncio.sleep(self.sleep_tune)
-                #logstring("8")
-            #logstring("Geez, that took:  {}  {}   {}        ??????????????????".format(elapsed_time, current_time, elapsed_time - current_time))
 
         reply = ''
-        #logstring("9")
         for x in self.query_reply_data.get(PrivateConstants.REPORT_FIRMWARE):
             reply_data = ord(x)
             if reply_data:
                 reply += chr(reply_data)
         self.query_reply_data[PrivateConstants.REPORT_FIRMWARE] = reply
-        #logstring("10")
         return self.query_reply_data.get(PrivateConstants.REPORT_FIRMWARE)
 
-    async def get_protocol_version(self):
+    async def get_protocol_version(self, timeout=3):
         """
         This method returns the major and minor values for the protocol
         version, i.e. 2.4
 
-        :returns: Firmata protocol version
+        :param timeout: seconds to wait for the reply
+        :returns: Firmata protocol version, or None if a timeout occurs
         """
         if self.query_reply_data.get(PrivateConstants.REPORT_VERSION) == '':
-            await self._send_command([PrivateConstants.REPORT_VERSION])
-            while self.query_reply_data.get(
-                    PrivateConstants.REPORT_VERSION) == '':
-                await asyncio.sleep(self.sleep_tune)
+            reply = await self._query(PrivateConstants.REPORT_VERSION,
+                                      lambda: self._send_command([PrivateConstants.REPORT_VERSION]),
+                                      timeout)
+            if not reply:
+                return None
         return self.query_reply_data.get(PrivateConstants.REPORT_VERSION)
 
-    async def get_pin_state(self, pin):
+    async def get_pin_state(self, pin, timeout=3):
         """
         This method retrieves a pin state report for the specified pin
 
         :param pin: Pin of interest
-        :returns: pin state report
+        :param timeout: seconds to wait for the reply
+        :returns: pin state report, or None if a timeout occurs
         """
         pin_list = [pin]
-        await self._send_sysex(PrivateConstants.PIN_STATE_QUERY, pin_list)
-        while self.query_reply_data.get(
-                PrivateConstants.PIN_STATE_RESPONSE) is None:
-            await asyncio.sleep(self.sleep_tune)
-        pin_state_report = self.query_reply_data.get(
-            PrivateConstants.PIN_STATE_RESPONSE)
-        self.query_reply_data[PrivateConstants.PIN_STATE_RESPONSE] = None
-        return pin_state_report
+        return await self._query((PrivateConstants.PIN_STATE_RESPONSE, pin),
+                                 lambda: self._send_sysex(PrivateConstants.PIN_STATE_QUERY, pin_list),
+                                 timeout)
 
     # noinspection PyMethodMayBeStatic
     async def get_wildcards_version(self):
@@ -1181,68 +1470,67 @@ class WildcardsFirmata(WildcardsFirmataBaseObject):
         It continually accepts and interprets data coming from Firmata,and then
         dispatches the correct handler to process the data.
 
+        Everything waiting in the ReadBuffer is handed to the frame parser in
+        one go, and the resulting messages are handled in batches of up to
+        dispatch_batch_size, yielding to the event loop once per batch.
+        The ReadBuffer is only read again once fewer than a batch of parsed
+        messages remain, so a backlog stays in the fixed size ReadBuffer,
+        which drops the oldest bytes when full, instead of growing here.
+
         :returns: This method never returns
         """
-        # sysex commands are assembled into this list for processing
-        #checkingport = self.serial_port.com_port
         logstring("Starting Command Dispatcher")
-        sysex = []
+        pending = self._pending_messages
+        # Firmata command -> its message counter, so the label lookup is done once
+        message_counters = {}
         while True:
             if self._valid_target_exists:
-                #logstring("Command Dispatcher: Valid Target")
-                try:
-                    #logstring("Command Dispatcher: Reading Next Byte")
-                    #donothing = self.donothingatall()
-                    #logstring("Command Dispatcher: didnothingatall")
-                    next_command_byte = await self.read_next_byte()
-                    #logstring("Command Dispatcher: Next Byte Read {}".format(next_command_byte))
-                    # if this is a SYSEX command, then assemble the entire
-                    # command process it
-                    if next_command_byte == PrivateConstants.START_SYSEX:
-                        while next_command_byte != PrivateConstants.END_SYSEX:
-                            # because self.  is awaited, i think we can remove this sleep, and the next
-                            #await asyncio.sleep(self.sleep_tune)
-                            next_command_byte = await self.read_next_byte()
-                            sysex.append(next_command_byte)
-                        await self.command_dictionary[sysex[0]](sysex)
-                        sysex = []
-                        await asyncio.sleep(self.sleep_tune)
-                    # if this is an analog message, process it.
-                    elif 0xE0 <= next_command_byte <= 0xEF:
-                        # analog message
-                        # assemble the entire analog message in command
-                        command = []
-                        # get the pin number for the message
-                        pin = next_command_byte & 0x0f
-                        command.append(pin)
-                        # get the next 2 bytes for the command
-                        command = await self._wait_for_data(command, 2)
-                        # process the analog message
-                        logstring("Analog Message received {}".format(command))
-                        await self._analog_message(command)
-                    # handle the digital message
-                    elif 0x90 <= next_command_byte <= 0x9F:
-                        command = []
-                        port = next_command_byte & 0x0f
-                        command.append(port)
-                        command = await self._wait_for_data(command, 2)
-                        await self._digital_message(command)
-                    # handle all other messages by looking them up in the
-                    # command dictionary
-                    elif next_command_byte in self.command_dictionary:
-                        await self.command_dictionary[next_command_byte]()
-                        await asyncio.sleep(self.sleep_tune)
-                    else:
-                        # we need to yield back to the loop
-                        await asyncio.sleep(self.sleep_tune)
-                        continue
-                    #logstring("finished this read cycle")
-                except ConnectionAbortedError as ex:
-                    logstring(ex)
-                    #print("An exception occurred on the asyncio event loop while receiving data.  Invalid message.")
+                if len(pending) < self.dispatch_batch_size:
+                    chunk = self.serial_manager.ReadBuffer.read()
+                    if chunk:
+                        pending.extend(self._parser.feed(chunk))
+                if not pending:
+                    await self._wait_for_read_data()
+                    continue
+                for _ in range(min(self.dispatch_batch_size, len(pending))):
+                    command, data = pending.popleft()
+                    counter = message_counters.get(command)
+                    if counter is None:
+                        counter = message_counters[command] = \
+                            Metrics.FIRMATA_MESSAGES.labels("0x{:02X}".format(command))
+                    counter.inc()
+                    start_time = time.perf_counter()
+                    try:
+                        await self._dispatch_message(command, data)
+                    except ConnectionAbortedError as ex:
+                        logsampled("{}", ex, level=logging.INFO)
+                    Metrics.FIRMATA_DISPATCH_SECONDS.observe(time.perf_counter() - start_time)
+                    if not self._valid_target_exists:
+                        pending.clear()
+                        break
+                # one yield per batch keeps the other tasks responsive
+                await asyncio.sleep(0)
             else:
+                pending.clear()
                 await asyncio.sleep(0.01)
 
+    async def _dispatch_message(self, command, data):
+        """
+        This is a private method.
+        Calls the handler for one complete message produced by the frame parser
+
+        :param command: message type, as returned by FirmataParser.feed()
+        :param data: message data, as returned by FirmataParser.feed()
+        :returns: No return value
+        """
+        if command == PrivateConstants.ANALOG_MESSAGE:
+            logsampled("Analog Message received {}", data)
+            await self._analog_message(data)
+        elif command == PrivateConstants.DIGITAL_MESSAGE:
+            await self._digital_message(data)
+        elif command in self.command_dictionary:
+            await self.command_dictionary[command](data)
+
     '''
     Firmata message handlers
     '''
@@ -1257,6 +1545,7 @@ class WildcardsFirmata(WildcardsFirmataBaseObject):
         """
         self.query_reply_data[PrivateConstants.ANALOG_MAPPING_RESPONSE] = \
             data[1:-1]
+        self._resolve_query(PrivateConstants.ANALOG_MAPPING_RESPONSE, data[1:-1])
 
     async def _analog_message(self, data):
         """
@@ -1296,6 +1585,7 @@ class WildcardsFirmata(WildcardsFirmataBaseObject):
         :returns: None - but report is saved
         """
         self.query_reply_data[PrivateConstants.CAPABILITY_RESPONSE] = data[1:-1]
+        self._resolve_query(PrivateConstants.CAPABILITY_RESPONSE, data[1:-1])
 
     async def _digital_message(self, data):
         """
@@ -1311,7 +1601,7 @@ class WildcardsFirmata(WildcardsFirmataBaseObject):
             port_data = (data[PrivateConstants.MSB] << 7) + \
                         data[PrivateConstants.LSB]
             port_starting_pin = port * 8
-            logstring("Digital message received: {} {}  {}".format(port, port_data, port_starting_pin))
+            logsampled("Digital message received: {} {}  {}", port, port_data, port_starting_pin)
             for pin in range(port_starting_pin, min(port_starting_pin + 8, len(self.digital_pins))):
                 # get pin value
                 #logstring("doing pin {}".format(pin))
@@ -1452,7 +1742,6 @@ class WildcardsFirmata(WildcardsFirmataBaseObject):
                 else:
                     loop = self.loop
                     loop.call_soon(cb, reply_data)
-                await asyncio.sleep(self.sleep_tune)
 
     async def _pin_state_response(self, data):
         """
@@ -1463,6 +1752,8 @@ class WildcardsFirmata(WildcardsFirmataBaseObject):
         :returns: None - but response is saved
         """
         self.query_reply_data[PrivateConstants.PIN_STATE_RESPONSE] = data[1:-1]
+        # the first byte after the command is the pin number the reply is for
+        self._resolve_query((PrivateConstants.PIN_STATE_RESPONSE, data[1]), data[1:-1])
 
     async def _report_firmware(self, sysex_data):
         """
@@ -1506,24 +1797,26 @@ class WildcardsFirmata(WildcardsFirmataBaseObject):
 
         # store the value
         self.query_reply_data[PrivateConstants.REPORT_FIRMWARE] = version_string
+        self._resolve_query(PrivateConstants.REPORT_FIRMWARE, version_string)
 
-    async def _report_version(self):
+    async def _report_version(self, data):
         """
         This is a private message handler method.
-        This method reads the following 2 bytes after the report version
+        This method handles the 2 bytes after the report version
         command (0xF9 - non sysex).
         The first byte is the major number and the second byte is the
         minor number.
 
+        :param data: [major, minor]
         :returns: None
         """
-        # get next two bytes
-        major = await self.read()
+        major = data[0]
         version_string = str(major)
-        minor = await self.read()
+        minor = data[1]
         version_string += '.'
         version_string += str(minor)
         self.query_reply_data[PrivateConstants.REPORT_VERSION] = version_string
+        self._resolve_query(PrivateConstants.REPORT_VERSION, version_string)
 
     async def _sonar_data(self, data):
         """
@@ -1541,30 +1834,24 @@ class WildcardsFirmata(WildcardsFirmataBaseObject):
                   data[PrivateConstants.LSB])
         reply_data = []
 
-        sonar_pin_entry = self.active_sonar_map[pin_number]
-
-        if sonar_pin_entry[0] is not None:
-            # check if value changed since last reading
-            if sonar_pin_entry[2] != val:
-                sonar_pin_entry[2] = val
-                self.active_sonar_map[pin_number] = sonar_pin_entry
-                # Do a callback if one is specified in the table
-                if sonar_pin_entry[0]:
-                    # if this is an asyncio callback type
-                    reply_data.append(pin_number)
-                    reply_data.append(val)
-                    if inspect.iscoroutinefunction(sonar_pin_entry[0]):
-                        await sonar_pin_entry[0](reply_data)
-                    else:
-                        loop = self.loop
-                        loop.call_soon(sonar_pin_entry[0], reply_data)
+        sonar_pin_entry = self.active_sonar_map.get(pin_number)
+        if sonar_pin_entry is None:
+            return
 
-        # update the data in the table with latest value
-        else:
+        # check if value changed since last reading
+        if sonar_pin_entry[1] != val:
+            # update the data in the table with latest value
             sonar_pin_entry[1] = val
-            self.active_sonar_map[pin_number] = sonar_pin_entry
-
-        await asyncio.sleep(self.sleep_tune)
+            # Do a callback if one is specified in the table
+            if sonar_pin_entry[0]:
+                # if this is an asyncio callback type
+                reply_data.append(pin_number)
+                reply_data.append(val)
+                if inspect.iscoroutinefunction(sonar_pin_entry[0]):
+                    await sonar_pin_entry[0](reply_data)
+                else:
+                    loop = self.loop
+                    loop.call_soon(sonar_pin_entry[0], reply_data)
 
     async def _string_data(self, data):
         """
@@ -1691,6 +1978,66 @@ class WildcardsFirmata(WildcardsFirmataBaseObject):
             updated_latch_entry[Constants.LATCHED_TIME_STAMP] = time.time()
             self.latch_map[key] = updated_latch_entry
 
+    async def _query(self, key, send, timeout):
+        """
+        This is a private utility method.
+        Sends a query to Firmata and waits for the message handler to
+        resolve the reply. If a query with the same key is already in
+        flight, the message is not sent again and the reply is shared.
+
+        :param key: identifies the expected reply
+        :param send: callable returning an awaitable that sends the query
+                     message; not called when a query is already in flight
+        :param timeout: seconds to wait for the reply
+        :returns: the reply data, or None on timeout or disconnect
+        """
+        future = self._pending_queries.get(key)
+        if future is None or future.done():
+            future = asyncio.get_event_loop().create_future()
+            self._pending_queries[key] = future
+            await send()
+        self._query_waiters[future] = self._query_waiters.get(future, 0) + 1
+        try:
+            # shield, so that one caller timing out doesn't cancel the others
+            reply = await asyncio.wait_for(asyncio.shield(future), timeout)
+            Tracing.mark_current(Tracing.REPLY)
+            return reply
+        except asyncio.TimeoutError:
+            # the query is only abandoned once nobody is waiting for a late reply
+            if self._query_waiters[future] == 1 and self._pending_queries.get(key) is future:
+                del self._pending_queries[key]
+            return None
+        finally:
+            waiters = self._query_waiters[future] - 1
+            if waiters:
+                self._query_waiters[future] = waiters
+            else:
+                del self._query_waiters[future]
+
+    def _resolve_query(self, key, value):
+        """
+        This is a private utility method.
+        Hands a reply to everyone waiting on the query identified by key
+
+        :param key: identifies the reply
+        :param value: the reply data
+        :returns: No return value
+        """
+        future = self._pending_queries.pop(key, None)
+        if future is not None and not future.done():
+            future.set_result(value)
+
+    def _fail_pending_queries(self):
+        """
+        This is a private utility method.
+        Releases everyone waiting on a query with a None reply
+        """
+        pending = self._pending_queries
+        self._pending_queries = {}
+        for future in pending.values():
+            if not future.done():
+                future.set_result(None)
+
     async def _send_command(self, command):
         """
         This is a private utility method.
@@ -1699,17 +2046,14 @@ class WildcardsFirmata(WildcardsFirmataBaseObject):
         :param command:  command data
         :returns: length of data sent
         """
-        send_message = ""
-
-        for i in command:
-            send_message += chr(i)
+        send_message = bytes(command)
         result = None
-        for data in send_message:
-            if self.serial_port is not None:
-                try:
-                    result = self.write(data)
-                except():
-                    logerr('Cannot send command')
+        if self.serial_port is not None:
+            try:
+                result = self.write(send_message)
+                Tracing.mark_current(Tracing.SERIAL_WRITE)
+            except():
+                logerr('Cannot send command')
         return result
 
     async def _send_sysex(self, sysex_command, sysex_data=None):
@@ -1724,47 +2068,39 @@ class WildcardsFirmata(WildcardsFirmataBaseObject):
         if not sysex_data:
             sysex_data = []
         #logstring("sending {}".format(sysex_command))
-        # convert the message command and data to characters
-        sysex_message = chr(PrivateConstants.START_SYSEX)
-        sysex_message += chr(sysex_command)
-        if len(sysex_data):
-            for d in sysex_data:
-                sysex_message += chr(d)
-        sysex_message += chr(PrivateConstants.END_SYSEX)
-        for data in sysex_message:
-            if self.serial_port is not None:
-                #print("serial port is {}".format(self.serial_port))
-                 #someday make write awaitable
-                #logstring("{}".format(data))
-                self.write(data)
-        #await asyncio.sleep(0.1)
-
-
-    async def _wait_for_data(self, current_command, number_of_bytes):
-        """
-        This is a private utility method.
-        This method accumulates the requested number of bytes and
-        then returns the full command
+        # assemble the whole frame so that it goes out in a single write
+        sysex_message = bytearray([PrivateConstants.START_SYSEX, sysex_command])
+        sysex_message.extend(sysex_data)
+        sysex_message.append(PrivateConstants.END_SYSEX)
+        if self.serial_port is not None:
+            #someday make write awaitable
+            self.write(sysex_message)
+            Tracing.mark_current(Tracing.SERIAL_WRITE)
 
-        :param current_command:  command id
-        :param number_of_bytes:  how many bytes to wait for
-        :returns: command
-        """
-        while number_of_bytes:
-            next_command_byte = await self.read_next_byte()
-            current_command.append(next_command_byte)
-            number_of_bytes -= 1
-        return current_command
 
     async def write_continuously(self):
-        start_time = time.perf_counter()
-        end_time = time.perf_counter()
+        """
+        Writes pending output to the board. Sleeps until a Pin, Port, Tone or
+        KeepAlive reports itself dirty, then writes everything that is
+        pending as a single frame.
+
+        :returns: This method never returns
+        """
         while True:
+            await self._output_ready.wait()
+            self._output_ready.clear()
+
             #take everything that needs to be written and store it as a byte string
-            data = self.generate_byte_string()
+            if not self._board_verified or self._output_hold:
+                #leave everything queued until the board has answered,
+                #or until a group of updates is complete
+                continue
+            for hook in self._pre_flush_hooks:
+                hook()
+            data = self._generate_dirty_byte_string()
             #logstring("sending byte string {}".format(data))
-
-
+            if not (self._valid_target_exists and len(data) > 0):
+                continue
 
             #estimate how long the write will take, and add  a little
             #extra downtime ( like 10% could be removed for throughput reasons later)
@@ -1773,21 +2109,20 @@ class WildcardsFirmata(WildcardsFirmataBaseObject):
             #will block, but FTDI's VCP won't block until/unless the buffers are full)
             write_time = self._estimate_write_time(data) * 1.1
 
-            #set the sleep time to the write time + margin, or the tune time (typ 1ms),
-            #whichever is larger
-            if write_time < self.sleep_tune:
-                write_time = self.sleep_tune
+            Tracing.TRACER.frame_generated()
             start_time = time.perf_counter()
-            if self._valid_target_exists and len(data) > 0:
-                self.write(data)
-            else:
-                #if there was nothing to write, just set the write time back to the tune time
-                write_time = self.sleep_tune
+            self.write(data)
             end_time = time.perf_counter()
+            Tracing.TRACER.frame_written()
+            Metrics.FRAME_BYTES.observe(len(data))
 
-            #sleep until the tune time is up, or the write time + margin has expired (whichever is greater)
+            #don't send the next frame until this one has had time to leave the port;
+            #anything marked dirty meanwhile goes out together in the next frame
             if end_time - start_time < write_time:
+                Metrics.PACING_SLEEP_SECONDS.observe(write_time - (end_time - start_time))
                 await asyncio.sleep(write_time - (end_time - start_time))
+            else:
+                Metrics.PACING_SLEEP_SECONDS.observe(0)
 
 
     def _estimate_write_time(self, data):
@@ -1800,27 +2135,29 @@ class WildcardsFirmata(WildcardsFirmataBaseObject):
         :param data:  bytes being sent to the write command
         :returns: estimated time to send the message in seconds
         """
-        return (len(data.encode('utf-8'))/(self.byte_rate))*1.25
+        return (len(data)/(self.byte_rate))*1.25
         #1.25 multiplier accounts for start & stop bits
 
 
 
-    async def read_next_byte(self):
-        while True:
-            #logstring("So we're in --...")
-            #logstring("So 2....   {}".format(self.serial_manager.ReadBuffer))
-            #logstring("So 3...  {}".format(len(self.serial_manager.ReadBuffer)))
-            if len(self.serial_manager.ReadBuffer) > 0:
-                val =  self.serial_manager.ReadBuffer.pop(0)
-                #logstring("Popping from ReadBuffer:   {}".format(val))
-                return val
-            else:
-                if self._valid_target_exists:
-                    #logstring("Nothing in buffer, sleeping")
-                    await asyncio.sleep(0.1)
-                else:
-                    logstring("No valid target...")
-                    raise ConnectionAbortedError("No Valid Target Connected")  #may want to change this...
+    async def _wait_for_read_data(self, timeout=0.1):
+        """
+        This is a private utility method.
+        Waits until the serial manager signals that new bytes are in the
+        ReadBuffer. The timeout only bounds how long it takes to notice
+        that the target has gone away.
+
+        :param timeout: longest time to wait in seconds
+        :returns: No return value
+        """
+        data_available = self.serial_manager.DataAvailable
+        data_available.clear()
+        if len(self.serial_manager.ReadBuffer) > 0:
+            return
+        try:
+            await asyncio.wait_for(data_available.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
 
 async def read_nothing():
     return None
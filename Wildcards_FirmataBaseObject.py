@@ -35,17 +35,32 @@ class WildcardsFirmataBaseObject:
         #default boolean to track whether something needs to be written.
         #Derived classes may use alternative implementations
         self._to_be_written = False
+        #called with this object whenever it has something new to write
+        self._dirty_listener = None
+
+    def set_dirty_listener(self, listener):
+        """
+        Registers a callable that is notified when this object needs to be written
+
+        :param listener: callable taking this object as its only argument
+        """
+        self._dirty_listener = listener
+
+    def _mark_dirty(self):
+        """
+        Lets the listener (normally the output scheduler, or the parent
+        object) know that this object has bytes waiting to be written
+        """
+        if self._dirty_listener is not None:
+            self._dirty_listener(self)
 	
 		
     def generate_byte_string(self):
         """
-        Creates the byte string for this object and any children objects
+        Creates the byte string (as bytes) for this object and any children objects
         """
-        byte_string = ""
         #logstring("ID is {}".format(self._ID))
-        for x in self._nested_objects:
-            #logstring("ID is {}".format(x._ID))
-            byte_string += x.generate_byte_string()
+        byte_string = b"".join([x.generate_byte_string() for x in self._nested_objects])
         self._to_be_written = False
         return byte_string
 		
@@ -67,7 +82,7 @@ def WrapSysEx(bytestring):
     
     :returns: bytestring with the leading and trailing SysEx bytes added
     """
-    return chr(PrivateConstants.START_SYSEX) + bytestring + chr(PrivateConstants.END_SYSEX)
+    return bytes([PrivateConstants.START_SYSEX]) + bytestring + bytes([PrivateConstants.END_SYSEX])
 
 def UnwrapSysEx(bytestring):
     """
@@ -86,13 +101,20 @@ def To7BitBytes(x, NumBytes=1):
     :param x:  value to convert
     :param NumBytes:  the lenght of the resulting bytestring
     
-    :returns: byte string of length NumBytes
+    :returns: bytes of length NumBytes
     """
-    result = chr(x & 0x7f)
-    for bytenum in range(1,NumBytes):
-        result = result + chr((x >> bytenum*7) & 0x7f)
-    return result
+    return bytes([(x >> bytenum*7) & 0x7f for bytenum in range(NumBytes)])
     
+def isnumeric(x):
+    """
+    Determines whether the input can be used as a number
+
+    :param x:  value to check
+
+    :returns: True if x is an int, float or Decimal (but not a bool)
+    """
+    return isinstance(x, (int, float, decimal.Decimal)) and not isinstance(x, bool)
+
 def round_decimal(x, digits = 0):
     """
     Performs traditonal rounding as taught in math classes
@@ -0,0 +1,106 @@
+"""
+ Copyright (c) 2018 Dynamic Phase, LLC All rights reserved.
+
+ This program is free software; you can redistribute it and/or
+ modify it under the terms of the GNU AFFERO GENERAL PUBLIC LICENSE
+ Version 3 as published by the Free Software Foundation; either
+ or (at your option) any later version.
+ This library is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ General Public License for more details.
+
+ You should have received a copy of the GNU AFFERO GENERAL PUBLIC LICENSE
+ along with this library; if not, write to the Free Software
+ Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+"""
+
+from private_constants import PrivateConstants
+from Wildcards_Logger import *
+
+class FirmataParser:
+    """
+    Incremental parser that turns chunks of bytes received from Firmata
+    into complete messages.
+
+    feed() may be given any number of bytes, including partial messages;
+    incomplete trailing data is held until the next call. Each message is
+    returned as a (command, data) tuple, where data has the same layout the
+    WildcardsFirmata message handlers expect:
+
+        sysex:          (sysex command, [sysex command, ..., END_SYSEX])
+        analog message: (ANALOG_MESSAGE, [pin, lsb, msb])
+        digital message:(DIGITAL_MESSAGE, [port, lsb, msb])
+        report version: (REPORT_VERSION, [major, minor])
+
+    Bytes that don't belong to a recognized message are skipped, so the
+    parser resynchronizes on the next command byte after any corruption.
+    """
+
+    def __init__(self, max_sysex_size=8192):
+        """
+        :param max_sysex_size: sysex frames longer than this are discarded
+                               rather than buffered indefinitely
+        """
+        self.max_sysex_size = max_sysex_size
+        self._pending = b''
+        self.discarded_bytes = 0
+
+    def reset(self):
+        """
+        Throws away any partially received message
+        """
+        self._pending = b''
+
+    def feed(self, data):
+        """
+        Parses as many complete messages as possible
+
+        :param data: bytes, bytearray or memoryview just received
+        :returns: list of (command, data) tuples, in arrival order
+        """
+        if self._pending:
+            buffer = self._pending + bytes(data)
+        else:
+            buffer = bytes(data)
+        view = memoryview(buffer)
+        length = len(buffer)
+        messages = []
+        i = 0
+        while i < length:
+            command = buffer[i]
+            if command == PrivateConstants.START_SYSEX:
+                end = buffer.find(PrivateConstants.END_SYSEX, i + 1)
+                if end < 0:
+                    if length - i > self.max_sysex_size:
+                        logsampled("Discarding oversized sysex frame of {} bytes", length - i,
+                                   level=logging.INFO)
+                        self.discarded_bytes += length - i
+                        i = length
+                    break
+                if end > i + 1:
+                    # sysex payload starts with its command and keeps the END_SYSEX byte
+                    frame = view[i + 1:end + 1].tolist()
+                    messages.append((frame[0], frame))
+                i = end + 1
+            elif 0xE0 <= command <= 0xEF or 0x90 <= command <= 0x9F or \
+                    command == PrivateConstants.REPORT_VERSION:
+                if i + 3 > length:
+                    break
+                if buffer[i + 1] & 0x80 or buffer[i + 2] & 0x80:
+                    # a new command started before this one was complete
+                    self.discarded_bytes += 1
+                    i += 1
+                    continue
+                if command == PrivateConstants.REPORT_VERSION:
+                    messages.append((command, view[i + 1:i + 3].tolist()))
+                else:
+                    messages.append((command & 0xF0,
+                                     [command & 0x0F, buffer[i + 1], buffer[i + 2]]))
+                i += 3
+            else:
+                # stray byte outside of any message we know how to frame
+                self.discarded_bytes += 1
+                i += 1
+        self._pending = buffer[i:]
+        return messages
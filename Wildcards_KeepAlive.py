@@ -51,6 +51,7 @@ class KeepAlive(WildcardsFirmataBaseObject):
                 self._to_be_written = False
             else:
                 self._to_be_written = True
+                self._mark_dirty()
  
 
     @property
@@ -78,13 +79,14 @@ class KeepAlive(WildcardsFirmataBaseObject):
             self._margin = round_decimal(margin, 1)
 
     def generate_byte_string(self):
-        output = ""
+        output = b""
         if self._to_be_written == True:
             #creates the byte string and resets the to_be_written state
-            output = WrapSysEx(KEEP_ALIVE + To7BitBytes(self._interval, 2))
+            output = WrapSysEx(bytes([PrivateConstants.KEEP_ALIVE]) + To7BitBytes(self._interval, 2))
             self._last_sent_interval = self._interval
             #record this timestamp as the last time the keepalive was sent
             self._last_ping = time.perf_counter()
+            self._to_be_written = False
         return output
 
     async def _ping_keepalive(self):
@@ -92,6 +94,7 @@ class KeepAlive(WildcardsFirmataBaseObject):
             if self._last_sent_interval > 0:
                 if (time.perf_counter() - self._last_ping) < (self._last_sent_interval * self._margin):  
                     self._to_be_written = True
+                    self._mark_dirty()
             #regardless, we can now sleep for a half second, 
             #which is guaranteed to be less than the minimum keepalive interval
             await asyncio.sleep(0.5)
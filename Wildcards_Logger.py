@@ -15,37 +15,322 @@
  Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 """
 
+import atexit
+import gzip
 import logging
+import logging.handlers
+import os
+import queue
+import shutil
+import sys
+import threading
+import time
+
+# Logging for Wildcards Link.
+#
+# Messages go to one of the subsystem loggers below, each of which can have
+# its own level. logstring() picks the subsystem from the module it is called
+# from (see _MODULE_SUBSYSTEMS), unless one is given explicitly.
+#
+# Records are handed to a QueueHandler, and a QueueListener thread does the
+# file and console output, so no file I/O happens on the event loop thread.
+# Use logdebug() for messages on hot paths: it takes format() arguments and
+# does no formatting at all unless debug output is enabled for the subsystem.
+# Messages that can repeat many times a second should use logsampled(), which
+# logs the first few of each kind per interval and then a count of the rest.
+#
+# The log file is capped in size. When full it is rotated and the old file
+# compressed to Wildcards.log.1.gz, Wildcards.log.2.gz and so on.
+
+SUBSYSTEMS = ("serial", "firmata", "server", "discovery", "watchdog")
+
+# "wildcards" is the parent of all subsystem loggers, and is also used for
+# messages from modules that don't belong to a subsystem
+_root_logger = logging.getLogger("wildcards")
+_loggers = {name: logging.getLogger("wildcards." + name) for name in SUBSYSTEMS}
+
+_MODULE_SUBSYSTEMS = {
+    "Wildcards_Serial": "serial",
+    "Wildcards_SerialPort": "serial",
+    "Wildcards_RingBuffer": "serial",
+    "Wildcards_SerialPortChecker": "discovery",
+    "Wildcards_BoardProfileCache": "discovery",
+    "Wildcards_Firmata": "firmata",
+    "Wildcards_FirmataParser": "firmata",
+    "Wildcards_FirmataBaseObject": "firmata",
+    "Wildcards_Pin": "firmata",
+    "Wildcards_Port": "firmata",
+    "Wildcards_Tone": "firmata",
+    "Wildcards_KeepAlive": "firmata",
+    "Wildcards_Server": "server",
+    "Wildcards_ClientSession": "server",
+    "Wildcards_BinaryProtocol": "server",
+    "Wildcards_Watchdog": "watchdog",
+}
 
 global_log_output = True
 #global_verbose = True
 global_verbose = False
 last_logstring = ""
 
+_listener = None
+
+LOG_FILE = './Wildcards.log'
+
+# logsampled() logs the first SAMPLE_FIRST messages of each kind in every
+# SAMPLE_INTERVAL seconds, and counts the rest
+SAMPLE_FIRST = 10
+SAMPLE_INTERVAL = 10.0
+# message format string -> [start of interval, messages seen, messages suppressed,
+# logger, level]
+_samples = {}
+# guards _samples, which the flusher thread also reads
+_samples_lock = threading.Lock()
+# set to stop the thread that writes the summaries of bursts that have ended
+_flusher_stop = None
+_flusher = None
+
 
-def logstring(mystring, optional=None):
+def get_logger(subsystem=None):
+    """
+    :param subsystem: one of SUBSYSTEMS, or None for the top level logger
+    :returns: the logging.Logger for the subsystem
+    """
+    if subsystem is None:
+        return _root_logger
+    return _loggers[subsystem]
+
+
+def _caller_logger(subsystem, depth=2):
+    if subsystem is not None:
+        return _loggers[subsystem]
+    module = sys._getframe(depth).f_globals.get("__name__")
+    subsystem = _MODULE_SUBSYSTEMS.get(module)
+    if subsystem is None:
+        return _root_logger
+    return _loggers[subsystem]
+
+
+def logstring(mystring, optional=None, subsystem=None):
+    """
+    Logs an informational message
+
+    :param mystring: message, or any object to log the str() of
+    :param optional: unused, kept for existing callers
+    :param subsystem: subsystem to log to; defaults to the caller's
+    """
     global last_logstring
-    global global_log_output
-    global global_verbose
     last_logstring = mystring
-    if global_log_output:
-        logging.info(mystring)
-    if global_verbose:
-        print(mystring, flush=True)
+    logger = _caller_logger(subsystem)
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(mystring)
+
+
+def logdebug(message, *args, subsystem=None):
+    """
+    Logs a debug message. The message is only formatted, with
+    message.format(*args), if debug output is enabled for the subsystem.
+
+    :param message: format string
+    :param args: format arguments
+    :param subsystem: subsystem to log to; defaults to the caller's
+    """
+    logger = _caller_logger(subsystem)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(message.format(*args) if args else message)
+
+
+def logsampled(message, *args, level=logging.DEBUG, subsystem=None):
+    """
+    Logs a message that may repeat at a high rate. Messages with the same
+    format string are "similar": only the first SAMPLE_FIRST of them in each
+    SAMPLE_INTERVAL are logged, and the number suppressed is logged once the
+    interval is over, by the next similar message or by the flusher thread.
+
+    :param message: format string
+    :param args: format arguments
+    :param level: logging level, DEBUG by default
+    :param subsystem: subsystem to log to; defaults to the caller's
+    """
+    logger = _caller_logger(subsystem)
+    if not logger.isEnabledFor(level):
+        return
+    now = time.monotonic()
+    with _samples_lock:
+        sample = _samples.get(message)
+        if sample is None or now - sample[0] >= SAMPLE_INTERVAL:
+            if sample is not None:
+                _log_suppressed(message, sample, now)
+            sample = _samples[message] = [now, 0, 0, logger, level]
+        sample[1] += 1
+        if sample[1] > SAMPLE_FIRST:
+            sample[2] += 1
+            return
+    logger.log(level, message.format(*args) if args else message)
+
+
+def _log_suppressed(message, sample, now):
+    if sample[2]:
+        sample[3].log(sample[4], "suppressed {} similar messages in the last {:.0f} s: {}".format(
+            sample[2], now - sample[0], message))
+
+
+def flush_sampled(everything=False):
+    """
+    Logs the "suppressed" summary of every sampled message whose interval has
+    ended, so a burst that stops is still reported
+
+    :param everything: also summarize intervals that are still running
+    """
+    now = time.monotonic()
+    with _samples_lock:
+        for message, sample in list(_samples.items()):
+            if everything or now - sample[0] >= SAMPLE_INTERVAL:
+                _log_suppressed(message, sample, now)
+                del _samples[message]
+
 
-def setup_global_log_output(truetolog, verbose):
+def _flush_sampled_periodically(stop):
+    while not stop.wait(SAMPLE_INTERVAL):
+        flush_sampled()
+
+
+def _gzip_namer(name):
+    return name + ".gz"
+
+
+def _gzip_rotator(source, dest):
+    # runs on the listener thread, like all other file output
+    with open(source, 'rb') as source_file, gzip.open(dest, 'wb') as dest_file:
+        shutil.copyfileobj(source_file, dest_file)
+    os.remove(source)
+
+
+def logerr(mystring, subsystem=None):
+    """
+    Logs an error, with the traceback of the exception being handled, if any
+    """
+    logger = _caller_logger(subsystem)
+    logger.error(mystring, exc_info=sys.exc_info()[0] is not None)
+
+
+def set_log_levels(levels):
+    """
+    Sets logging levels
+
+    :param levels: dictionary of subsystem name (or None for all of Wildcards) to a
+                   logging level, e.g. {None: logging.INFO, "serial": logging.DEBUG}
+    """
+    for subsystem, level in levels.items():
+        get_logger(subsystem).setLevel(level)
+
+
+def parse_log_levels(text):
+    """
+    Parses a level specification such as "INFO" or "WARNING,serial=DEBUG,server=INFO"
+
+    :returns: dictionary for set_log_levels
+    """
+    levels = {}
+    for item in text.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        if "=" in item:
+            subsystem, level = item.split("=", 1)
+            subsystem = subsystem.strip().lower()
+            if subsystem not in SUBSYSTEMS:
+                raise ValueError("Unknown log subsystem {}; expected one of {}".format(subsystem, ", ".join(SUBSYSTEMS)))
+        else:
+            subsystem, level = None, item
+        level = level.strip().upper()
+        if not isinstance(logging.getLevelName(level), int):
+            raise ValueError("Unknown log level {}".format(level))
+        levels[subsystem] = logging.getLevelName(level)
+    return levels
+
+
+def setup_global_log_output(truetolog, verbose, levels=None, max_bytes=5 * 1024 * 1024, backup_count=5):
+    """
+    Starts log output. May be called again to change the outputs.
+
+    :param truetolog: write the log to LOG_FILE. The log of the previous run is
+                      kept as the first compressed backup
+    :param verbose: also print log messages to the console
+    :param levels: optional dictionary for set_log_levels; by default everything
+                   at INFO and above is logged
+    :param max_bytes: size at which the log file is rotated
+    :param backup_count: number of compressed old log files to keep
+    """
     global last_logstring
     global global_log_output
     global global_verbose
+    global _listener
     last_logstring = ""
-    global_log_ouptut = truetolog
+    global_log_output = truetolog
     global_verbose = verbose
-    #print("sawthis...{}".format(last_logstring))
-    logging.basicConfig(filename='./Wildcards.log', filemode='w',
-        level=logging.DEBUG)
-        
-def logerr(mystring):
-    if global_log_output:
-        logging.exception(mystring)
-    if global_verbose:
-        print(mystring, flush=True)
+
+    shutdown_logging()
+
+    handlers = []
+    if truetolog:
+        file_handler = logging.handlers.RotatingFileHandler(LOG_FILE, maxBytes=max_bytes,
+                                                            backupCount=backup_count)
+        file_handler.namer = _gzip_namer
+        file_handler.rotator = _gzip_rotator
+        if os.path.exists(LOG_FILE) and os.path.getsize(LOG_FILE) > 0:
+            # start each run with a fresh file, keeping the last run's log
+            file_handler.doRollover()
+        file_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+        handlers.append(file_handler)
+    if verbose:
+        console_handler = logging.StreamHandler(sys.stdout)
+        console_handler.setFormatter(logging.Formatter("%(message)s"))
+        handlers.append(console_handler)
+
+    for handler in list(_root_logger.handlers):
+        _root_logger.removeHandler(handler)
+    _root_logger.propagate = False
+    _root_logger.setLevel(logging.INFO)
+    if levels:
+        set_log_levels(levels)
+
+    if handlers:
+        log_queue = queue.SimpleQueue() if hasattr(queue, "SimpleQueue") else queue.Queue()
+        _root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+        _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+        _listener.start()
+        _start_flusher()
+    else:
+        _root_logger.addHandler(logging.NullHandler())
+
+
+def _start_flusher():
+    global _flusher
+    global _flusher_stop
+    _flusher_stop = threading.Event()
+    _flusher = threading.Thread(target=_flush_sampled_periodically, args=(_flusher_stop,),
+                                name="Wildcards log sampler", daemon=True)
+    _flusher.start()
+
+
+def shutdown_logging():
+    """
+    Stops the listener thread after it has written everything queued so far,
+    including the summaries of sampled messages
+    """
+    global _listener
+    global _flusher
+    if _flusher is not None:
+        _flusher_stop.set()
+        _flusher.join()
+        _flusher = None
+    if _listener is not None:
+        flush_sampled(everything=True)
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+
+atexit.register(shutdown_logging)
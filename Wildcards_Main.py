@@ -34,6 +34,11 @@ from Wildcards_UserInterface import WildCardsUserInterface
 from Wildcards_Serial import WildCardsSerial
 from Wildcards_Firmata import WildcardsFirmata
 from Wildcards_Server import WildServer
+from Wildcards_BoardProfileCache import BoardProfileCache
+import Wildcards_BinaryProtocol as BinaryProtocol
+from Wildcards_Metrics import MetricsServer
+import Wildcards_Tracing as Tracing
+from Wildcards_Watchdog import Watchdog
 #import Wildcards_Logger
 from Wildcards_Logger import *
 
@@ -54,15 +59,22 @@ class WildCardsMain:
 
         #set up the serial link to Firmata
         self.WildSerial = None
-        self.WildSerial = WildCardsSerial(parent=self)
-        self.WildFirmata = WildcardsFirmata(parent=self)
+        self.WildSerial = WildCardsSerial(parent=self, read_buffer_size=read_buffer_size)
+        self.WildFirmata = WildcardsFirmata(parent=self, dispatch_batch_size=dispatch_batch_size,
+                                            board_profiles=BoardProfileCache())
 
         loop.create_task(self.CheckForNewUserInputs())
 
-        self.server = WildServer(parent=self, my_firmata=self.WildFirmata)
+        self.server = WildServer(parent=self, my_firmata=self.WildFirmata, snapshot_on_connect=snapshot_on_connect)
+        self.metrics_server = None
+        if metrics_port is not None:
+            self.metrics_server = MetricsServer(port=metrics_port)
 
         self._new_serial_port = None
 
+        if watchdog is not None:
+            watchdog.start(loop)
+
         loop.create_task(self.KeepServerAlive())
         loop.create_task(self.WildFirmata.write_continuously())
 
@@ -74,7 +86,8 @@ class WildCardsMain:
     async def KeepServerAlive(self):
         self.server.portnumber = serverport
         if self.start_server is None:
-            self.start_server = websockets.serve(self.server.get_message, '127.0.0.1', serverport)
+            self.start_server = websockets.serve(self.server.get_message, '127.0.0.1', serverport,
+                                                 subprotocols=[BinaryProtocol.SUBPROTOCOL])
         try:
             await asyncio.gather(self.start_server, loop=loop)
             logstring("Server listining on port {}".format(serverport))
@@ -82,6 +95,11 @@ class WildCardsMain:
         except:
             logstring("Error setting up server")
             pass
+        if self.metrics_server is not None:
+            try:
+                await self.metrics_server.start()
+            except OSError as ex:
+                logstring("Error setting up metrics server on port {}: {}".format(metrics_port, ex))
 
     def ServerListening(self, portnumber):
         self.WildUI.UpdateServerPort(portnumber)
@@ -165,6 +183,18 @@ class WildCardsMain:
       --wait WAIT          Arduino wait time
       --comport COM        Arduino COM port
       --sleep SLEEP        sleep tune in ms.
+      --readbuffer SIZE    serial read buffer size in bytes
+      --dispatchbatch N    messages from the board handled before yielding to other tasks
+      --metricsport PORT   port for the HTTP /metrics endpoint; auto for the server
+                           port + 1, off to disable
+      --trace              record command latency traces from startup
+      --stallms MS         report the event loop as stalled after this many ms
+                           without running; off to disable
+      --snapshot           send each new connection a snapshot of the board state
+      --loglevel LEVELS    log level, optionally per subsystem (serial, firmata,
+                           server, discovery, watchdog), e.g. INFO,serial=DEBUG
+      --logsize MB         log file size in MB before it is rotated
+      --logbackups N       number of compressed old log files to keep
       -v --verbose VERBOSE send output to file
       -l --logging LOG     send output to console
 """
@@ -175,6 +205,20 @@ parser.add_argument("--port", dest="port", default="9000", help="Server port num
 parser.add_argument("--wait", dest="wait", default="2", help="Reset wait time in seconds")
 parser.add_argument("--comport", dest="com", default="None", help="COM port")
 parser.add_argument("--sleep", dest="sleep", default=".001", help="sleep tune in ms.")
+parser.add_argument("--readbuffer", dest="readbuffer", default="4096", help="serial read buffer size in bytes")
+parser.add_argument("--dispatchbatch", dest="dispatchbatch", default="64",
+                    help="messages from the board handled before yielding to other tasks")
+parser.add_argument("--metricsport", dest="metricsport", default="auto",
+                    help="port for the HTTP /metrics endpoint; auto for the server port + 1, off to disable")
+parser.add_argument("--trace", dest="trace", action="store_true", help="record command latency traces from startup")
+parser.add_argument("--stallms", dest="stallms", default="250",
+                    help="report the event loop as stalled after this many ms without running; off to disable")
+parser.add_argument("--snapshot", dest="snapshot", action="store_true", help="send each new connection a snapshot of the board state")
+parser.add_argument("--loglevel", dest="loglevel", default="INFO",
+                    help="log level, optionally per subsystem (serial, firmata, server, discovery, watchdog), "
+                         "e.g. INFO,serial=DEBUG")
+parser.add_argument("--logsize", dest="logsize", default="5", help="log file size in MB before it is rotated")
+parser.add_argument("--logbackups", dest="logbackups", default="5", help="number of compressed old log files to keep")
 parser.add_argument("-v", "--verbose", dest="verbose", action="store_true", help="increase output verbosity")
 parser.add_argument("-l", "--logging", dest="logging", action="store_true", help="log outputs to ./Wildcards.log")
 
@@ -187,6 +231,27 @@ else:
 
 serverport = args.port
 
+read_buffer_size = int(args.readbuffer)
+
+dispatch_batch_size = int(args.dispatchbatch)
+
+snapshot_on_connect = args.snapshot
+
+if args.trace:
+    Tracing.TRACER.enable()
+
+if args.stallms == 'off':
+    watchdog = None
+else:
+    watchdog = Watchdog(threshold=float(args.stallms) / 1000)
+
+if args.metricsport == 'off':
+    metrics_port = None
+elif args.metricsport == 'auto':
+    metrics_port = int(serverport) + 1
+else:
+    metrics_port = int(args.metricsport)
+
 
 
 
@@ -199,12 +264,17 @@ serverport = args.port
 
 #Wildcards_Logger.setup_global_log_output(args.logging, args.verbose)
 #Wildcards_Logger.setup_global_log_output(True, True)
-setup_global_log_output(True, True)
+setup_global_log_output(True, True, parse_log_levels(args.loglevel),
+                        max_bytes=int(float(args.logsize) * 1024 * 1024), backup_count=int(args.logbackups))
 
 #remove this later? only makes sense when run from console because this runs in the background
 
 #catch WM_CLOSE for windows?
 def _signal_handler(sig, frame):
+    #stop watching the loop first, so stopping it isn't reported as a stall
+    if watchdog is not None:
+        watchdog.stop()
+
     #schedule the closing of all asynchronous generator objects via calls to aclose()
     loop.create_task(loop.shutdown_asyncgens())
 
@@ -0,0 +1,348 @@
+"""
+ Copyright (c) 2018 Dynamic Phase, LLC All rights reserved.
+
+ This program is free software; you can redistribute it and/or
+ modify it under the terms of the GNU AFFERO GENERAL PUBLIC LICENSE
+ Version 3 as published by the Free Software Foundation; either
+ or (at your option) any later version.
+ This library is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ General Public License for more details.
+
+ You should have received a copy of the GNU AFFERO GENERAL PUBLIC LICENSE
+ along with this library; if not, write to the Free Software
+ Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+"""
+
+import asyncio
+import bisect
+import math
+
+from Wildcards_Logger import *
+
+# Counters, gauges and histograms for watching the link under load, and a
+# small HTTP server that exports them in the Prometheus text format at
+# /metrics.
+#
+# All updates happen on the event loop thread, so nothing here is locked.
+# A metric with labels is updated through the child returned by
+# labels(...); hot paths can keep that child instead of looking it up
+# each time.
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if value == -math.inf:
+        return "-Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class _Metric:
+    type_name = None
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        if not self.labelnames:
+            self._children[()] = self._new_child()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        """
+        :param values: one value per label name
+        :returns: the child metric for those label values
+        """
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError("{} takes labels {}, but {} were given".format(self.name, self.labelnames, values))
+            child = self._children[values] = self._new_child()
+        return child
+
+    def _label_string(self, values, extra=()):
+        pairs = ['{}="{}"'.format(name, _escape(value))
+                 for name, value in list(zip(self.labelnames, values)) + list(extra)]
+        if not pairs:
+            return ""
+        return "{" + ",".join(pairs) + "}"
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.help),
+                 "# TYPE {} {}".format(self.name, self.type_name)]
+        for values, child in sorted(self._children.items()):
+            lines.extend(self._render_child(values, child))
+        return lines
+
+    def _render_child(self, values, child):
+        return ["{}{} {}".format(self.name, self._label_string(values), _format_value(child.get()))]
+
+
+class _CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def get(self):
+        return self.value
+
+
+class Counter(_Metric):
+    """
+    A value that only goes up, such as a number of bytes or messages
+    """
+    type_name = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self._children[()].value += amount
+
+
+class _GaugeChild:
+    __slots__ = ("value", "function")
+
+    def __init__(self):
+        self.value = 0
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set_function(self, function):
+        """
+        Makes the gauge report function() whenever it is collected
+        """
+        self.function = function
+
+    def get(self):
+        if self.function is not None:
+            try:
+                return self.function()
+            except Exception as ex:
+                logstring("Unable to collect a gauge value: {}".format(ex))
+                return math.nan
+        return self.value
+
+
+class Gauge(_Metric):
+    """
+    A value that goes up and down, such as a queue depth
+    """
+    type_name = "gauge"
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value):
+        self._children[()].set(value)
+
+    def inc(self, amount=1):
+        self._children[()].inc(amount)
+
+    def dec(self, amount=1):
+        self._children[()].dec(amount)
+
+    def set_function(self, function):
+        self._children[()].set_function(function)
+
+
+class _HistogramChild:
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Histogram(_Metric):
+    """
+    Counts observations, such as durations or sizes, in buckets
+    """
+    type_name = "histogram"
+
+    # suits durations in seconds, from 100 us to 10 s
+    DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                       0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.bounds = tuple(sorted(buckets))
+        super().__init__(name, help_text, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.bounds)
+
+    def observe(self, value):
+        self._children[()].observe(value)
+
+    def _render_child(self, values, child):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.bounds + (math.inf,), child.counts):
+            cumulative += count
+            lines.append("{}_bucket{} {}".format(self.name, self._label_string(values, [("le", _format_value(float(bound)))]),
+                                                 cumulative))
+        label_string = self._label_string(values)
+        lines.append("{}_sum{} {}".format(self.name, label_string, _format_value(child.sum)))
+        lines.append("{}_count{} {}".format(self.name, label_string, child.count))
+        return lines
+
+
+class MetricsRegistry:
+    """
+    The set of metrics exported together
+    """
+
+    def __init__(self):
+        self._metrics = {}
+
+    def _register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError("Metric {} is already registered".format(metric.name))
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help_text, labelnames=()):
+        return self._register(Counter(name, help_text, labelnames))
+
+    def gauge(self, name, help_text, labelnames=()):
+        return self._register(Gauge(name, help_text, labelnames))
+
+    def histogram(self, name, help_text, labelnames=(), buckets=Histogram.DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help_text, labelnames, buckets))
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def render(self):
+        """
+        :returns: all metrics in the Prometheus text exposition format
+        """
+        lines = []
+        for name in sorted(self._metrics):
+            lines.extend(self._metrics[name].render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 4096)
+
+# serial link
+SERIAL_BYTES_READ = REGISTRY.counter("wildcards_serial_bytes_read_total",
+                                     "Bytes read from the serial port")
+SERIAL_BYTES_WRITTEN = REGISTRY.counter("wildcards_serial_bytes_written_total",
+                                        "Bytes written to the serial port")
+SERIAL_WRITES = REGISTRY.counter("wildcards_serial_writes_total",
+                                 "Write calls made on the serial port")
+READ_BUFFER_DEPTH = REGISTRY.gauge("wildcards_read_buffer_bytes",
+                                   "Bytes waiting in the serial read buffer")
+READ_BUFFER_DROPPED = REGISTRY.counter("wildcards_read_buffer_dropped_bytes_total",
+                                       "Bytes discarded because the serial read buffer overflowed")
+
+# firmata core
+FIRMATA_MESSAGES = REGISTRY.counter("wildcards_firmata_messages_total",
+                                    "Messages received from the board, by Firmata command", ("command",))
+FIRMATA_DISPATCH_SECONDS = REGISTRY.histogram("wildcards_firmata_dispatch_seconds",
+                                              "Time to handle one message from the board, including callbacks")
+FRAME_BYTES = REGISTRY.histogram("wildcards_write_frame_bytes",
+                                 "Size of the frames written by write_continuously", buckets=_SIZE_BUCKETS)
+PACING_SLEEP_SECONDS = REGISTRY.histogram("wildcards_write_pacing_sleep_seconds",
+                                          "Time write_continuously waits after a frame for it to leave the port")
+
+# websocket server
+WEBSOCKET_CONNECTIONS = REGISTRY.gauge("wildcards_websocket_connections",
+                                       "Open websocket connections")
+WEBSOCKET_CONNECTIONS_TOTAL = REGISTRY.counter("wildcards_websocket_connections_total",
+                                               "Websocket connections accepted")
+WEBSOCKET_MESSAGES_IN = REGISTRY.counter("wildcards_websocket_messages_in_total",
+                                         "Commands received from clients, by method", ("method",))
+WEBSOCKET_MESSAGES_OUT = REGISTRY.counter("wildcards_websocket_messages_out_total",
+                                          "Replies and notifications sent to clients, by method", ("method",))
+CALLBACK_SECONDS = REGISTRY.histogram("wildcards_callback_seconds",
+                                      "Time spent in the server's board data callbacks", ("callback",))
+SUPERSEDED_WRITES = REGISTRY.counter("wildcards_superseded_writes_total",
+                                     "Pin writes replaced by a newer write before being sent")
+
+# event loop
+EVENT_LOOP_LAG_SECONDS = REGISTRY.histogram("wildcards_event_loop_lag_seconds",
+                                            "How late the watchdog heartbeat woke up")
+EVENT_LOOP_STALLS = REGISTRY.counter("wildcards_event_loop_stalls_total",
+                                     "Heartbeats that woke up later than the stall threshold")
+TASKS = REGISTRY.gauge("wildcards_tasks",
+                       "Live asyncio tasks, by coroutine", ("coroutine",))
+
+
+class MetricsServer:
+    """
+    Serves REGISTRY over HTTP at /metrics, for scraping by a local collector
+    """
+
+    def __init__(self, host='127.0.0.1', port=9001, registry=REGISTRY):
+        self.host = host
+        self.port = port
+        self.registry = registry
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        logstring("Metrics available at http://{}:{}/metrics".format(self.host, self.port))
+
+    def close(self):
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 5)
+            # skip the headers
+            while True:
+                line = await asyncio.wait_for(reader.readline(), 5)
+                if line in (b"\r\n", b"\n", b""):
+                    break
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+                status = "200 OK"
+                body = self.registry.render().encode("utf-8")
+                content_type = "text/plain; version=0.0.4; charset=utf-8"
+            else:
+                status = "404 Not Found"
+                body = b"Not Found\n"
+                content_type = "text/plain"
+            writer.write("HTTP/1.1 {}\r\nContent-Type: {}\r\nContent-Length: {}\r\nConnection: close\r\n\r\n"
+                         .format(status, content_type, len(body)).encode("latin-1") + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
@@ -179,18 +179,22 @@ class Pin(WildcardsFirmataBaseObject):
             pass #no encoder? interesting....
             #unknown pin mode, do nothing
         logstring("Pin {} set to mode {}".format(self._PinNum, self._mode))
+        self._update_dirty()
     
     def enable_digital_reporting(self):
         self._DigitalReportingEnabled = True
         self._need_to_send_digital_reporting = True
+        self._update_dirty()
 
     def disable_digital_reporting(self):
         self._DigitalReportingEnabled = False        
         self._need_to_send_digital_reporting = True
+        self._update_dirty()
         
     def enable_analog_reporting(self):
         self._report_analog = 1     #can only do reporting on up to 16 analog pins, because firmata uses an int to store this info
         self._need_to_send_analog_reporting = True  #don't need to check if it is changing; if this is called, send it again
+        self._update_dirty()
      
     def disable_analog_reporting(self):
         self._report_analog = 0
@@ -198,6 +202,7 @@ class Pin(WildcardsFirmataBaseObject):
             self._need_to_send_analog_reporting = False
         else:
             self._need_to_send_analog_reporting = True        
+        self._update_dirty()
        
     def AnalogWrite(self, value):
         if self._mode == Constants.SERVO or self._mode == Constants.PWM:
@@ -206,6 +211,7 @@ class Pin(WildcardsFirmataBaseObject):
                 self._need_to_perform_analog_write = True
             else:
                 self._need_to_perform_analog_write = False
+            self._update_dirty()
     
    
           
@@ -224,11 +230,12 @@ class Pin(WildcardsFirmataBaseObject):
 
                     #no need to re-send if we're just changing the positive value used
                     #but do re-send if we're going 0 to non zero (or vice versa)
-                    logstring("Performing Digital Write")
+                    logdebug("Performing Digital Write")
                     self._need_to_perform_digital_write = True
                 else:
-                    logstring("No need to perform Digital Write")
+                    logdebug("No need to perform Digital Write")
                     self._need_to_perform_digital_write = False
+                self._update_dirty()
 
         
     def ConfigServo(self, min_pulse, max_pulse):
@@ -242,9 +249,16 @@ class Pin(WildcardsFirmataBaseObject):
         else:
             self._need_to_write_mode = False
             self._need_to_config_servo = True 
+            self._update_dirty()
      
     def PinStateQuery(self):
         self._need_to_query_pin_state = True 
+        self._update_dirty()
+
+    def _update_dirty(self):
+        #digital writes and digital reporting are sent by the port, so they count too
+        if self.to_be_written or self._need_to_send_digital_reporting:
+            self._mark_dirty()
         
     @property
     def DigitalReportingEnabled(self):
@@ -256,6 +270,14 @@ class Pin(WildcardsFirmataBaseObject):
 
                 
         
+    @property
+    def mode(self):
+        return self._mode
+
+    @property
+    def AnalogPinNum(self):
+        return self._AnalogPinNum
+
     @property
     def value(self):
         return self._value
@@ -278,16 +300,16 @@ class Pin(WildcardsFirmataBaseObject):
         return self._need_to_perform_digital_write               
         
     def generate_byte_string(self):
-        output = ""
+        output = b""
         if self._need_to_config_servo == True:
-            output += WrapSysEx(chr(PrivateConstants.SERVO_CONFIG) + chr(self._PinNum) +
+            output += WrapSysEx(bytes([PrivateConstants.SERVO_CONFIG]) + bytes([self._PinNum]) +
                                To7BitBytes(self._servo_min_pulse, 2) +
                                To7BitBytes(self._servo_max_pulse, 2)) 
             self._last_sent_servo_min_pulse = self._servo_min_pulse
             self._last_sent_servo_max_pulse = self._servo_max_pulse                  
             self._need_to_config_servo = False
         if self._need_to_write_mode == True:
-            output += chr(PrivateConstants.SET_PIN_MODE) + \
+            output += bytes([PrivateConstants.SET_PIN_MODE]) + \
                      To7BitBytes(self._PinNum) + \
                      To7BitBytes(self._mode) 
             self._last_sent_mode = self._mode
@@ -295,7 +317,7 @@ class Pin(WildcardsFirmataBaseObject):
         if self._need_to_send_analog_reporting == True:
             if self._AnalogPinNum < 16:
                 #Firmata allows analog reporting only for the first 16 analog pins
-                output += chr(PrivateConstants.REPORT_ANALOG + self._AnalogPinNum) + \
+                output += bytes([PrivateConstants.REPORT_ANALOG + self._AnalogPinNum]) + \
                               To7BitBytes(self._report_analog)
             self._need_to_send_analog_reporting = False
         if self._need_to_send_digital_reporting == True:
@@ -307,16 +329,16 @@ class Pin(WildcardsFirmataBaseObject):
         if self._need_to_perform_analog_write == True:
             if self._PinNum < 16:
                 #send via normal analog write
-                output += chr(PrivateConstants.ANALOG_MESSAGE + self._PinNum) + \
+                output += bytes([PrivateConstants.ANALOG_MESSAGE + self._PinNum]) + \
                               To7BitBytes(self._value, 2)
             else: # #################make sure this was fixed
                 #send via sysex as extended analog
-                output += WrapSysEx(chr(PrivateConstants.EXTENDED_ANALOG) + \
+                output += WrapSysEx(bytes([PrivateConstants.EXTENDED_ANALOG]) + \
                                To7BitBytes(self._PinNum) +\
                                To7BitBytes(self._value, 3)) 
             self._need_to_perform_analog_write = False
         if self._need_to_query_pin_state == True:  
-            output += WrapSysEx(chr(PrivateConstants.PIN_STATE_QUERY) + \
+            output += WrapSysEx(bytes([PrivateConstants.PIN_STATE_QUERY]) + \
                                 To7BitBytes(self._PinNum))
             self._need_to_query_pin_state = False 
         self._last_sent_value = self._value
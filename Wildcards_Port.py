@@ -44,16 +44,30 @@ class Port(WildcardsFirmataBaseObject):
         
         #timestamp messages as they are received for comparison purposes?
         
-    def enable_digital_reporting(self, value):
+    def enable_digital_reporting(self):
         self._report_digital = 1
         self._need_to_send_digital_reporting = True
+        self._mark_dirty()
      
     def disable_digital_reporting(self):
         self._report_digital = 0
-        if  self._report_digital == self._last_sent_report_digital:
+        if  self._report_digital == self.last_sent_report_digital:
             self._need_to_send_digital_reporting = False
         else:
             self._need_to_send_digital_reporting = True        
+            self._mark_dirty()
+
+    def add_pin(self, pin):
+        """
+        Adds a pin to this port. Changes to the pin mark the whole port
+        as needing to be written, since digital writes and reporting are
+        sent per port.
+        """
+        self.pins.append(pin)
+        pin.set_dirty_listener(self._pin_dirty)
+
+    def _pin_dirty(self, pin):
+        self._mark_dirty()
             
     def DigitalWrite(self, value):  #writes an entire port of 1s and 0s at once
         for i, pin in enumerate(self.pins):
@@ -68,7 +82,7 @@ class Port(WildcardsFirmataBaseObject):
         """
         Creates the byte string for this object and any children objects
         """
-        byte_string = ""
+        byte_string = b""
         need_to_perform_digital_write = False
         digital_value_to_write = 0
         digital_reporting = self._report_digital  #if the port has digital reporting turned on, then report digital
@@ -89,12 +103,13 @@ class Port(WildcardsFirmataBaseObject):
             for i, pin in enumerate(self.pins):
                 if pin.value:
                     byte_to_write += (1 << i)
-            byte_string += chr(PrivateConstants.DIGITAL_MESSAGE + (0x0F & self._PortNum)) + \
+            byte_string += bytes([PrivateConstants.DIGITAL_MESSAGE + (0x0F & self._PortNum)]) + \
                                To7BitBytes(byte_to_write, 2)  
                                
         if self._need_to_send_digital_reporting:
-            byte_string += chr(PrivateConstants.REPORT_DIGITAL + (0x0F & self._PortNum)) + \
+            byte_string += bytes([PrivateConstants.REPORT_DIGITAL + (0x0F & self._PortNum)]) + \
                                To7BitBytes(digital_reporting)              
+            self.last_sent_report_digital = digital_reporting
         self._need_to_send_digital_reporting = False
         
         return byte_string
@@ -0,0 +1,125 @@
+"""
+ Copyright (c) 2018 Dynamic Phase, LLC All rights reserved.
+
+ This program is free software; you can redistribute it and/or
+ modify it under the terms of the GNU AFFERO GENERAL PUBLIC LICENSE
+ Version 3 as published by the Free Software Foundation; either
+ or (at your option) any later version.
+ This library is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ General Public License for more details.
+
+ You should have received a copy of the GNU AFFERO GENERAL PUBLIC LICENSE
+ along with this library; if not, write to the Free Software
+ Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+"""
+
+from Wildcards_Logger import *
+
+class RingBuffer:
+    """
+    Fixed-capacity byte FIFO backed by a bytearray.
+
+    Bytes read from the serial port are appended in bulk with extend() and
+    consumed with pop() or read(), both of which are O(1) per byte consumed.
+
+    Overflow policy: when more bytes arrive than there is free space, the
+    oldest unread bytes are discarded to make room. Firmata messages start
+    with a command byte (>= 0x80), so the reader resynchronizes on the next
+    message after a drop. The number of discarded bytes is kept in
+    dropped_bytes.
+    """
+
+    def __init__(self, capacity=4096):
+        """
+        :param capacity: maximum number of unread bytes held at once
+        """
+        if capacity <= 0:
+            raise ValueError("RingBuffer capacity must be positive, "
+                             "but {} was provided".format(capacity))
+        self._capacity = capacity
+        self._buffer = bytearray(capacity)
+        self._head = 0   #index of the oldest unread byte
+        self._count = 0  #number of unread bytes
+        self.dropped_bytes = 0
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    def clear(self):
+        self._head = 0
+        self._count = 0
+
+    def extend(self, data):
+        """
+        Appends data to the buffer, discarding the oldest bytes on overflow
+
+        :param data: bytes, bytearray or memoryview to append
+        :returns: number of bytes discarded to make room
+        """
+        data = memoryview(data)
+        length = len(data)
+        if length == 0:
+            return 0
+
+        dropped = 0
+        if length >= self._capacity:
+            #only the newest capacity bytes can be kept
+            dropped = self._count + length - self._capacity
+            data = data[length - self._capacity:]
+            length = self._capacity
+            self._head = 0
+            self._count = 0
+        elif self._count + length > self._capacity:
+            dropped = self._count + length - self._capacity
+            self._head = (self._head + dropped) % self._capacity
+            self._count -= dropped
+
+        tail = (self._head + self._count) % self._capacity
+        first = min(length, self._capacity - tail)
+        self._buffer[tail:tail + first] = data[:first]
+        if first < length:
+            self._buffer[0:length - first] = data[first:]
+        self._count += length
+
+        if dropped:
+            self.dropped_bytes += dropped
+            logsampled("Read buffer overflow: discarded {} oldest bytes", dropped, level=logging.INFO)
+        return dropped
+
+    def pop(self):
+        """
+        Removes and returns the oldest unread byte
+
+        :returns: the byte as an int
+        """
+        if self._count == 0:
+            raise IndexError("pop from an empty RingBuffer")
+        value = self._buffer[self._head]
+        self._head = (self._head + 1) % self._capacity
+        self._count -= 1
+        return value
+
+    def read(self, size=None):
+        """
+        Removes and returns up to size of the oldest unread bytes
+
+        :param size: maximum number of bytes to return, None for everything
+        :returns: bytes
+        """
+        if size is None or size > self._count:
+            size = self._count
+        if size <= 0:
+            return b''
+        first = min(size, self._capacity - self._head)
+        result = bytes(self._buffer[self._head:self._head + first])
+        if first < size:
+            result += bytes(self._buffer[0:size - first])
+        self._head = (self._head + size) % self._capacity
+        self._count -= size
+        return result
@@ -25,17 +25,25 @@ from threading import Thread
 from itertools import cycle
 import serial.tools.list_ports
 from Wildcards_SerialPort import SerialPort
+from Wildcards_RingBuffer import RingBuffer
+import Wildcards_Metrics as Metrics
 
 from Wildcards_Logger import *
 
 class WildCardsSerial:
 
-    def __init__(self, parent=None, com_port=None, speed=57600, sleep_tune=.5):
+    def __init__(self, parent=None, com_port=None, speed=57600, sleep_tune=.5,
+                 read_buffer_size=4096, event_driven=True):
         """
         This is the constructor for the aio serial handler
 
         :param com_port: Com port designator
         :param speed: baud rate
+        :param read_buffer_size: capacity in bytes of the receive ring buffer.
+                                 When it overflows the oldest bytes are dropped
+        :param event_driven: register open ports with the event loop so reads
+                             happen as soon as data arrives, rather than polling.
+                             Falls back to polling where that isn't supported
         :return: None
         """
         self._parent = parent
@@ -46,7 +54,11 @@ class WildCardsSerial:
         self.CurrentPort = None
         self.Ports = []
         sys.stdout.flush()
-        self.ReadBuffer = []
+        self.ReadBuffer = RingBuffer(read_buffer_size)
+        #set whenever new bytes are placed in ReadBuffer
+        self.DataAvailable = asyncio.Event()
+        Metrics.READ_BUFFER_DEPTH.set_function(lambda: len(self.ReadBuffer))
+        self.event_driven = event_driven
 
         # if MAC get list of ports
         if sys.platform.startswith('darwin'):
@@ -85,7 +97,7 @@ class WildCardsSerial:
         detected = None
 
         for device in self.locations:
-            self.Ports.append(SerialPort(self, device))
+            self.Ports.append(SerialPort(self, device, event_driven=self.event_driven))
         #logstring("Starting service")
         self.StartService() #does this go here?
 
@@ -117,6 +129,16 @@ class WildCardsSerial:
     def PortClosed(self, com_port):
         self._parent.SerialClosed()
 
+    def DataReceived(self, data):
+        """
+        Called by the current SerialPort (or Auto_Reader) with newly read bytes
+        """
+        dropped_bytes = self.ReadBuffer.dropped_bytes
+        self.ReadBuffer.extend(data)
+        if self.ReadBuffer.dropped_bytes != dropped_bytes:
+            Metrics.READ_BUFFER_DROPPED.inc(self.ReadBuffer.dropped_bytes - dropped_bytes)
+        self.DataAvailable.set()
+
     async def OpenNamedSerialPort(self, portname, clear_port_error_status = True):
         logstring("Opening port {}".format(portname))
         if portname not in self.locations: #add to locations if it isn't already in there
@@ -243,18 +265,23 @@ class WildCardsSerial:
         """
 
         This polls the com port continuously for updates and store the result in ReadBuffer
+        Ports that are event driven deliver their data through DataReceived
+        instead, so for those this just idles.
 
         :returns: Never returns, loops forever until program is exited
         """
         HasLogstringChanged = True
         while True:
-            if (self.CurrentPort is not None):
+            if (self.CurrentPort is not None) and self.CurrentPort.IsEventDriven:
+                HasLogstringChanged = True
+                await asyncio.sleep(0.2)
+            elif (self.CurrentPort is not None):
                 HasLogstringChanged = True
                 myresult = await self.CurrentPort.read()
                 #logstring("reading from port again: {}".format(myresult))
                 if myresult is not None:
-                    #logstring("found a char: {}".format(myresult))
-                    self.ReadBuffer.append(myresult)
+                    #logstring("found some chars: {}".format(myresult))
+                    self.DataReceived(myresult)
             else:
                 if HasLogstringChanged:
                     logstring("No active port connected; nothing to do")
@@ -17,11 +17,12 @@
 
 from Wildcards_Logger import *
 from Wildcards_SerialPortChecker import SerialPortChecker
+import Wildcards_Metrics as Metrics
 import serial
 import asyncio
 
 class SerialPort:
-    def __init__(self, parent, com_port, speed=57600, sleep_tune=.01):
+    def __init__(self, parent, com_port, speed=57600, sleep_tune=.01, event_driven=True):
         self._parent = parent
         self.com_port = com_port
         
@@ -30,6 +31,15 @@ class SerialPort:
         
         self._IsPortOpen = False
 
+        #event_driven requests that the serial file descriptor be registered with the
+        #event loop, so incoming data is pushed to the parent as soon as it arrives.
+        #_IsEventDriven records whether that registration actually succeeded; if it
+        #did not (e.g. Windows, where serial handles are not selectable) read() is
+        #polled instead
+        self.event_driven = event_driven
+        self._IsEventDriven = False
+        self._reader_fd = None
+
         
         #had_error indicates whether there was a write error or "this isn't Firmata" error
         #since the port was last available
@@ -52,6 +62,10 @@ class SerialPort:
     @property
     def IsPortOpen(self):
         return self._IsPortOpen
+
+    @property
+    def IsEventDriven(self):
+        return self._IsEventDriven
         
     # def _MarkPortAvailable(self):
         # if self.IsPortAvailable == False:
@@ -82,6 +96,62 @@ class SerialPort:
     def get_serial(self):
         return self.my_serial
 
+    def _add_reader(self):
+        """
+        Registers the serial file descriptor with the event loop so that
+        _data_ready is called whenever there is data waiting.
+        Leaves the port in polling mode if the platform or loop can't do this.
+        """
+        if not self.event_driven:
+            return
+        try:
+            fd = self.my_serial.fileno()
+            asyncio.get_event_loop().add_reader(fd, self._data_ready)
+        except (AttributeError, NotImplementedError, OSError, ValueError):
+            logstring("Event driven reads unavailable for {}; polling instead".format(self.com_port))
+            self._IsEventDriven = False
+            return
+        self._reader_fd = fd
+        self._IsEventDriven = True
+        logstring("Event driven reads enabled for {}".format(self.com_port))
+
+    def _remove_reader(self):
+        if self._reader_fd is not None:
+            try:
+                asyncio.get_event_loop().remove_reader(self._reader_fd)
+            except (NotImplementedError, OSError, ValueError):
+                pass
+            self._reader_fd = None
+        self._IsEventDriven = False
+
+    def _close_serial(self):
+        """
+        Unregisters any event loop reader and closes the pyserial object
+        """
+        self._remove_reader()
+        if self.my_serial is not None:
+            self.my_serial.close()
+
+    def _data_ready(self):
+        """
+        Event loop reader callback: moves everything waiting in the driver
+        into the parent's read buffer
+        """
+        try:
+            waiting = self.my_serial.in_waiting
+            #a readable descriptor with nothing waiting means the device went away;
+            #reading one byte lets pyserial raise the corresponding SerialException
+            data = self.my_serial.read(waiting or 1)
+        except (serial.SerialException, OSError):
+            logstring("Exception while reading from {}".format(self.com_port))
+            self.had_error = True
+            self._close_serial()
+            self._MarkPortClosed()
+            return
+        if data:
+            Metrics.SERIAL_BYTES_READ.inc(len(data))
+            self._parent.DataReceived(data)
+
     async def _KeepAvailabilityUpToDate(self):
         lastknownstatus = self.IsPortAvailable
         while True:
@@ -93,34 +163,33 @@ class SerialPort:
                     self._parent.AppendToPortList(self.com_port)
                 else:
                     self._parent.RemoveFromPortList(self.com_port) 
-                    self.my_serial.close()
+                    self._close_serial()
                     self._MarkPortClosed()
                 lastknownstatus = self.IsPortAvailable
             await asyncio.sleep(0.1)    
             
     def write(self, data):
         """
-        This is s call to pyserial write. It provides a
-        write and returns the number of bytes written upon
-        completion
+        This is s call to pyserial write. It writes the whole
+        frame with a single call and returns the number of bytes
+        written upon completion
 
-        :param data: Data to be written
+        :param data: Data to be written, as bytes or bytearray
         :return: Number of bytes written
         """
         if self._SerialPortChecker.IsPortAvailable and self._IsPortOpen:
             result = None
             try:
-                for d in data:
-                    result = self.my_serial.write(bytes([ord(d)]))
-                #result = self.my_serial.write(data.encode('utf-8'))
-                #print('Wrote {} on {}!'.format(ord(data),self.com_port))
-                    logstring('Wrote {} on {}'.format(bytes([ord(d)]),self.com_port))
-                #logstring('Wrote {} on {}!'.format(data.encode('utf-8'),self.com_port))
+                result = self.my_serial.write(data)
+                Metrics.SERIAL_WRITES.inc()
+                if result:
+                    Metrics.SERIAL_BYTES_WRITTEN.inc(result)
+                logsampled('Wrote {} bytes on {}: {}', result, self.com_port, data)
             except serial.SerialTimeoutException:
                 try:
                     logstring("TimeoutError while writing")
                     self.had_error = True
-                    self.my_serial.close()
+                    self._close_serial()
                     self._MarkPortClosed()
                 except:  
                     raise                
@@ -128,7 +197,7 @@ class SerialPort:
                 try:
                     logstring("SerialException while writing")
                     self.had_error = True
-                    self.my_serial.close()
+                    self._close_serial()
                     self._MarkPortClosed()
                 except:  
                     raise
@@ -136,14 +205,14 @@ class SerialPort:
                 try:
                     logstring("OSError while writing")
                     self.had_error = True
-                    self.my_serial.close()
+                    self._close_serial()
                     self._MarkPortClosed()
                 except:  
                     raise
             if result:
                 return result
         else:
-            logstring("Unable to write: {}".format(data))
+            logsampled("Unable to write: {}", data, level=logging.INFO)
             #pass
                 
   
@@ -152,7 +221,7 @@ class SerialPort:
         This is performs a read if there is any data waiting
         Otherwise it will return None and perform a brief sleep along the way
 
-        :return: One character
+        :return: All of the bytes waiting in the driver, or None
         """
 
         # wait for a character to become available and read from
@@ -160,18 +229,21 @@ class SerialPort:
         if (self.my_serial is not None) and self._SerialPortChecker.IsPortAvailable and self._IsPortOpen:
             #logstring("attempting a read: is it inwaiting? {}".format(self.my_serial.inWaiting()))
             try:            
-                if not self.my_serial.inWaiting():
+                waiting = self.my_serial.in_waiting
+                if not waiting:
                     #logstring("inWaiting is false, so sleeping for a bit..")
                     await asyncio.sleep(self.sleep_tune)
                     return None
                 else:
-                    data = self.my_serial.read()
-                    return ord(data)
+                    #pull everything the driver has buffered in a single call
+                    data = self.my_serial.read(waiting)
+                    Metrics.SERIAL_BYTES_READ.inc(len(data))
+                    return data
             except serial.SerialException:
                 try:
                     logstring("Serial Exception occured")
                     self.had_error = True
-                    self.my_serial.close()
+                    self._close_serial()
                     self._MarkPortClosed()
                     return None
                 except:  
@@ -180,7 +252,7 @@ class SerialPort:
                 try:
                     logstring("OSError occurred")
                     self.had_error = True
-                    self.my_serial.close()
+                    self._close_serial()
                     self._MarkPortClosed()
                     return None
                 except:  
@@ -195,7 +267,7 @@ class SerialPort:
         Close the serial port
         """
         if self._SerialPortChecker.IsPortAvailable and self._IsPortOpen:
-            self.my_serial.close()
+            self._close_serial()
             logstring("Closing up port {}".format(self.com_port))
             self._MarkPortClosed()
 
@@ -213,6 +285,7 @@ class SerialPort:
             
             self.my_serial.reset_output_buffer()
             self.my_serial.reset_input_buffer()
+            self._add_reader()
             self._parent.com_port = self.com_port
             self.had_error = False
             await self._MarkPortOpen()
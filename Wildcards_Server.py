@@ -23,16 +23,66 @@ import json
 import sys
 import signal
 import argparse
+import contextvars
+import functools
+import time
 import websockets
 from constants import Constants
 from serial import SerialException
 import serial
 
 from Wildcards_Logger import *
+from Wildcards_ClientSession import ClientSession, SubscriptionFilter
+import Wildcards_BinaryProtocol as BinaryProtocol
+import Wildcards_Metrics as Metrics
+import Wildcards_Tracing as Tracing
+
+# id of the request currently being handled, echoed in its reply
+_request_id = contextvars.ContextVar("request_id", default=None)
+
+# marks a missing encode cache entry, since None is a valid cached encoding
+_NOT_CACHED = object()
+
+
+def _timed_callback(callback):
+    """
+    Records the run time of a board data callback in Metrics.CALLBACK_SECONDS
+    """
+    histogram = Metrics.CALLBACK_SECONDS.labels(callback.__name__)
+
+    @functools.wraps(callback)
+    def wrapper(*args, **kwargs):
+        start_time = time.perf_counter()
+        try:
+            return callback(*args, **kwargs)
+        finally:
+            histogram.observe(time.perf_counter() - start_time)
+    return wrapper
 
 class WildServer:
-    def __init__(self, parent, my_firmata):
+    # notifications that are streams of sensor values, where only the latest
+    # value matters. These are coalesced for clients that enable batching and
+    # may be replaced or dropped when a client falls behind; latch and i2c
+    # notifications are always sent individually and never dropped
+    SENSOR_KINDS = frozenset(("analog", "digital", "encoder", "sonar"))
+
+    # commands, by the method name clients send, that wait for a reply from the
+    # board. These run as separate tasks so they don't hold up the commands a
+    # client sends after them; all other commands are handled in the order they arrive
+    QUERY_COMMANDS = frozenset(("get_analog_map", "get_capability_report", "get_firmware_version",
+                                "get_pin_state", "get_protocol_version"))
+
+    # pin writes that are buffered and applied once per output frame, keeping only
+    # the latest value per pin. Any other command applies the buffered writes first
+    COALESCED_COMMANDS = frozenset(("analog_write", "digital_pin_write", "digital_write"))
+
+    # most distinct notifications whose encoding is kept per event loop iteration
+    ENCODE_CACHE_SIZE = 256
+
+    def __init__(self, parent, my_firmata, snapshot_on_connect=False):
         self.core = my_firmata
+        # send every new connection a snapshot_reply before handling its requests
+        self.snapshot_on_connect = snapshot_on_connect
 
         self._parent = parent
 
@@ -70,42 +120,379 @@ class WildServer:
             "sonar_read": self.sonar_read,
             "servo_config": self.servo_config,
             "stepper_config": self.stepper_config,
-            "stepper_step": self.stepper_step
+            "stepper_step": self.stepper_step,
+            "subscribe": self.subscribe,
+            "unsubscribe": self.unsubscribe,
+            "set_batching": self.set_batching,
+            "get_connection_stats": self.get_connection_stats,
+            "batch": self.batch,
+            "get_snapshot": self.get_snapshot,
+            "set_tracing": self.set_tracing,
+            "get_trace_summary": self.get_trace_summary,
+            "get_traces": self.get_traces
         }
-        self.websocket = None
+        # one ClientSession per open websocket connection
+        self.sessions = set()
+        # maps a (kind, key) subscription, e.g. ("analog", 2), to the set of
+        # sessions that want those notifications
+        self._subscribers = {}
+        self._next_session_id = 1
+        # (protocol, method, params, param types) -> encoded notification, emptied on the next
+        # event loop iteration
+        self._encode_cache = {}
+        # pin -> (core write method, value) for writes not yet applied
+        self._pending_writes = {}
+        # writes that were replaced by a newer write to the same pin before being applied
+        self.superseded_writes = 0
+        self.core.add_pre_flush_hook(self._apply_pending_writes)
+        Metrics.WEBSOCKET_CONNECTIONS.set_function(lambda: len(self.sessions))
         #set default port number to 9000
         self.portnumber = 9000
 
     # noinspection PyUnusedLocal
     async def get_message(self, websocket, path):
         """
+        Handles one websocket connection for as long as it stays open.
+        Each connection gets its own ClientSession, which receives the
+        replies to its requests as well as all notifications.
+
+        A request may carry an "id" field, which is copied into its reply so
+        clients can have several requests outstanding. Queries that wait on
+        the board (QUERY_COMMANDS) run concurrently; everything else,
+        including all writes, is handled in arrival order.
 
         :param websocket: websocket
         :param path: path
         :return:
         """
-
-        self.websocket = websocket
+        binary = websocket.subprotocol == BinaryProtocol.SUBPROTOCOL
+        session = ClientSession(websocket, self._next_session_id, binary=binary)
+        self._next_session_id += 1
+        self.sessions.add(session)
+        Metrics.WEBSOCKET_CONNECTIONS_TOTAL.inc()
+        logstring("{} connected{}; {} open".format(session, " (binary)" if binary else "", len(self.sessions)))
         try:
+            if self.snapshot_on_connect:
+                await self.get_snapshot(session)
             while True:
-                payload = await self.websocket.recv()
-                logstring("Recieved payload: {}".format(payload))
-                # cmd_dict = json.loads(payload.decode('utf8'))
-                cmd_dict = json.loads(payload)
-                client_cmd = cmd_dict.get("method")
+                payload = await websocket.recv()
+                received = time.monotonic()
+                logdebug("Recieved payload: {}", payload)
+                request_id = None
+                if isinstance(payload, bytes):
+                    if not session.binary:
+                        logsampled("Ignoring binary frame from {}, which did not negotiate {}",
+                                   session, BinaryProtocol.SUBPROTOCOL, level=logging.WARNING)
+                        continue
+                    try:
+                        client_cmd, params = BinaryProtocol.decode_command(payload)
+                    except ValueError as e:
+                        logstring("Ignoring binary frame: {}".format(e))
+                        continue
+                else:
+                    # cmd_dict = json.loads(payload.decode('utf8'))
+                    cmd_dict = json.loads(payload)
+                    client_cmd = cmd_dict.get("method")
+                    params = cmd_dict.get("params")
+                    request_id = cmd_dict.get("id")
 
                 if client_cmd in self.command_map:
+                    Metrics.WEBSOCKET_MESSAGES_IN.labels(client_cmd).inc()
                     cmd = self.command_map.get(client_cmd)
-                    params = cmd_dict.get("params")
-                    if params[0] != "null":
-                        await cmd(params)
+                    if params and params[0] != "null":
+                        call = cmd(session, params)
                     else:
-                        await cmd()
+                        call = cmd(session)
+                    if client_cmd not in self.COALESCED_COMMANDS:
+                        self._apply_pending_writes()
+                    trace = Tracing.TRACER.start(client_cmd, received)
+                    if trace is not None:
+                        call = self._run_traced(call, trace)
+                    token = _request_id.set(request_id)
+                    trace_token = Tracing.current_trace.set(trace)
+                    try:
+                        if client_cmd in self.QUERY_COMMANDS:
+                            # the task gets a copy of the context, so it keeps the request id
+                            session.start_task(call)
+                        else:
+                            await call
+                    finally:
+                        Tracing.current_trace.reset(trace_token)
+                        _request_id.reset(token)
         except websockets.exceptions.ConnectionClosed:
             logstring('A websocket connections has closed')
+        finally:
+            session.close()
+            self._unsubscribe_all(session)
+            self.sessions.discard(session)
+            logstring("{} disconnected; {} open".format(session, len(self.sessions)))
+
+    def _broadcast(self, method, params):
+        """
+        Sends a notification to every open connection
 
+        :param method: reply method name
+        :param params: reply parameters
+        :returns: No return value
+        """
+        if not self.sessions:
+            return
+        reply = self._encode_notification("json", method, params)
+        for session in self.sessions:
+            session.send_soon(reply, method=method)
+
+    @staticmethod
+    def _encode_reply(message):
+        """
+        Encodes a reply to the request being handled, adding the request's
+        "id" if the client sent one
+
+        :param message: reply dictionary with "method" and "params"
+        :returns: encoded reply
+        """
+        request_id = _request_id.get()
+        if request_id is not None:
+            message["id"] = request_id
+        return json.dumps(message)
+
+    async def _send_reply(self, session, method, params):
+        """
+        Encodes a reply to the request being handled and queues it for the session
+
+        :param session: ClientSession that made the request
+        :param method: reply method name
+        :param params: reply parameters
+        """
+        await session.send(self._encode_reply({"method": method, "params": params}), method)
+
+    async def _send_error(self, session, method, message):
+        """
+        Tells the client that a request could not be carried out
 
-    async def analog_read(self, command):
+        :param method: method of the failed request
+        :param message: description of the problem
+        """
+        logstring("{}: {}".format(method, message))
+        await self._send_reply(session, "error_reply", [method, message])
+
+    async def _run_traced(self, call, trace):
+        """
+        Runs a command handler and records when it finished
+        """
+        try:
+            await call
+        finally:
+            Tracing.TRACER.handler_done(trace, bool(self._pending_writes) or self.core.output_pending())
+
+    def _queue_write(self, pin, write, value):
+        """
+        Buffers a pin write until the next output frame, replacing any
+        write to the same pin that hasn't been applied yet
+
+        :param pin: pin number
+        :param write: core method that applies the write, e.g. self.core.analog_write
+        :param value: value to write
+        :returns: No return value
+        """
+        if self._pending_writes.pop(pin, None) is not None:
+            self.superseded_writes += 1
+            Metrics.SUPERSEDED_WRITES.inc()
+        self._pending_writes[pin] = (write, value)
+        self.core.request_flush()
+
+    def _apply_pending_writes(self):
+        """
+        Applies the buffered pin writes, in the order the pins were last written
+        """
+        if not self._pending_writes:
+            return
+        pending = self._pending_writes
+        self._pending_writes = {}
+        for pin, (write, value) in pending.items():
+            try:
+                write(pin, value)
+            except IndexError:
+                logerr("Ignoring write to nonexistent pin {}".format(pin))
+
+    def _notify(self, kind, key, method, params):
+        """
+        Sends a notification to the sessions subscribed to (kind, key).
+        Nothing is encoded when nobody is subscribed.
+
+        :param kind: subscription kind, e.g. "analog"
+        :param key: pin number, trigger pin, i2c address or latch key
+        :param method: reply method name
+        :param params: reply parameters
+        :returns: No return value
+        """
+        sessions = self._subscribers.get((kind, key))
+        if not sessions:
+            return
+        now = None
+        for session in sessions:
+            sub_filter = session.subscriptions.get((kind, key))
+            if sub_filter is not None:
+                if now is None:
+                    now = time.monotonic()
+                if not sub_filter.offer(method, params, now):
+                    continue
+            self._deliver(session, kind, key, method, params)
+
+    def _deliver(self, session, kind, key, method, params):
+        """
+        Hands a notification to one session, in the form that session wants
+
+        :param session: receiving ClientSession
+        :param kind: subscription kind
+        :param key: subscription key
+        :param method: reply method name
+        :param params: reply parameters
+        :returns: No return value
+        """
+        sensor = kind in self.SENSOR_KINDS
+        if session.batch_window and sensor:
+            session.add_to_batch((kind, key), method, params)
+            return
+        if session.binary:
+            frame = self._encode_notification("binary", method, params)
+            if frame is not None:
+                session.send_soon(frame, key=(kind, key) if sensor else None, method=method)
+                return
+        reply = self._encode_notification("json", method, params)
+        if sensor:
+            session.send_soon(reply, key=(kind, key), method=method)
+        else:
+            session.send_soon(reply, method=method)
+
+    def _encode_notification(self, protocol, method, params):
+        """
+        Encodes a notification, reusing the result for identical notifications
+        in the same event loop iteration. Every recipient gets the same string
+        or bytes object, so the encoding cost doesn't grow with the client count.
+
+        :param protocol: "json" or "binary"
+        :param method: reply method name
+        :param params: reply parameters
+        :returns: encoded notification; None if the binary protocol has no layout for it
+        """
+        try:
+            # 1, 1.0 and True are equal as keys but encode differently, so the
+            # value types are part of the key
+            if isinstance(params, list):
+                cache_key = (protocol, method, tuple(params), tuple(map(type, params)))
+            else:
+                cache_key = (protocol, method, params, type(params))
+            encoded = self._encode_cache.get(cache_key, _NOT_CACHED)
+        except TypeError:
+            # nested lists, as in i2c data, can't be used as a key
+            cache_key = None
+            encoded = _NOT_CACHED
+        if encoded is not _NOT_CACHED:
+            return encoded
+        if protocol == "binary":
+            encoded = BinaryProtocol.encode_reply(method, params)
+        else:
+            encoded = json.dumps({"method": method, "params": params})
+        if cache_key is not None and len(self._encode_cache) < self.ENCODE_CACHE_SIZE:
+            if not self._encode_cache:
+                asyncio.get_event_loop().call_soon(self._encode_cache.clear)
+            self._encode_cache[cache_key] = encoded
+        return encoded
+
+    def _subscribe(self, session, kind, key, options=None):
+        """
+        Adds a subscription for the session. An existing subscription keeps its
+        filter unless options are given; an empty options dictionary removes it.
+
+        :param options: {"max_rate": HZ, "deadband": MIN_CHANGE, "deadband_percent": PERCENT},
+                        all optional. Only used for sensor kinds
+        """
+        self._subscribers.setdefault((kind, key), set()).add(session)
+        if options is None:
+            session.subscriptions.setdefault((kind, key), None)
+            return
+        old_filter = session.subscriptions.get((kind, key))
+        if old_filter is not None:
+            old_filter.cancel()
+        sub_filter = None
+        if options and kind in self.SENSOR_KINDS:
+            release = functools.partial(self._deliver, session, kind, key)
+            sub_filter = SubscriptionFilter(release,
+                                            max_rate=float(options.get("max_rate", 0)),
+                                            deadband=float(options.get("deadband", 0)),
+                                            deadband_percent=float(options.get("deadband_percent", 0)))
+        elif options:
+            logstring("{}: {} subscriptions don't take options".format(session, kind))
+        session.subscriptions[(kind, key)] = sub_filter
+
+    def _unsubscribe(self, session, kind, key):
+        sessions = self._subscribers.get((kind, key))
+        if sessions is not None:
+            sessions.discard(session)
+            if not sessions:
+                del self._subscribers[(kind, key)]
+        sub_filter = session.subscriptions.pop((kind, key), None)
+        if sub_filter is not None:
+            sub_filter.cancel()
+
+    def _unsubscribe_all(self, session):
+        for kind, key in list(session.subscriptions):
+            self._unsubscribe(session, kind, key)
+
+    @staticmethod
+    def _subscription_key(kind, key):
+        # latches are keyed by strings such as "A3"; everything else by number
+        if kind == "latch":
+            return str(key)
+        return int(key)
+
+
+    async def batch(self, session, command=None):
+        """
+        This method runs a list of commands in one pass. Output from all of them is held
+        back until the last one has run, so the pin updates reach the board together in
+        a single serial frame.
+
+        Commands in QUERY_COMMANDS and nested batches are not allowed and are skipped.
+        A batch that is empty or contains anything but command objects is rejected
+        as a whole, and none of it is run.
+
+        :param command: {"method": "batch", "params": [{"method": METHOD, "params": [PARAMS]}, ...]}
+        :returns: No return message, other than the replies of the individual commands.
+                  {"method": "error_reply", "params": ["batch", MESSAGE]} if the batch is rejected.
+        """
+        if not isinstance(command, list) or not command:
+            await self._send_error(session, "batch", "params must be a non-empty list of commands")
+            return
+        for sub_command in command:
+            if not isinstance(sub_command, dict) or not isinstance(sub_command.get("method"), str):
+                await self._send_error(session, "batch", "not a command: {}".format(sub_command))
+                return
+            if not isinstance(sub_command.get("params", []), list):
+                await self._send_error(session, "batch", "params of {} must be a list".format(sub_command["method"]))
+                return
+        self.core.hold_output()
+        try:
+            for sub_command in command:
+                method = sub_command.get("method")
+                if method == "batch" or method in self.QUERY_COMMANDS:
+                    logstring("batch: {} is not allowed in a batch".format(method))
+                    continue
+                cmd = self.command_map.get(method)
+                if cmd is None:
+                    logstring("batch: unknown method {}".format(method))
+                    continue
+                if method not in self.COALESCED_COMMANDS:
+                    self._apply_pending_writes()
+                params = sub_command.get("params", ["null"])
+                if params and params[0] != "null":
+                    await cmd(session, params)
+                else:
+                    await cmd(session)
+        finally:
+            self.core.release_output()
+
+    async def analog_read(self, session, command):
         """
         This method reads and returns the last reported value for an analog pin.
         Normally not used since analog pin updates will be provided automatically
@@ -117,23 +504,24 @@ class WildServer:
         """
         pin = int(command[0])
         data_val = await self.core.analog_read(pin)
-        reply = json.dumps({"method": "analog_read_reply", "params": [pin, data_val]})
-        await self.websocket.send(reply)
+        await self._send_reply(session, "analog_read_reply", [pin, data_val])
 
-    async def analog_write(self, command):
+    async def analog_write(self, session, command):
         """
         This method writes a value to an analog pin.
 
         It is used to set the output of a PWM pin or the angle of a Servo.
+        Writes are applied once per output frame; if several arrive for the same pin
+        in that time, only the latest is sent to the board.
 
         :param command: {"method": "analog_write", "params": [PIN, WRITE_VALUE]}
         :returns: No return message.
         """
         pin = int(command[0])
         value = int(command[1])
-        self.core.analog_write(pin, value)
+        self._queue_write(pin, self.core.analog_write, value)
 
-    async def digital_read(self, command):
+    async def digital_read(self, session, command):
         """
         This method reads and returns the last reported value for a digital pin.
         Normally not used since digital pin updates will be provided automatically
@@ -145,10 +533,9 @@ class WildServer:
         """
         pin = int(command[0])
         data_val = self.core.digital_read(pin)
-        reply = json.dumps({"method": "digital_read_reply", "params": [pin, data_val]})
-        await self.websocket.send(reply)
+        await self._send_reply(session, "digital_read_reply", [pin, data_val])
 
-    async def digital_pin_write(self, command):
+    async def digital_pin_write(self, session, command):
         """
         This method writes a zero or one to a digital pin.
 
@@ -157,9 +544,9 @@ class WildServer:
         """
         pin = int(command[0])
         value = int(command[1])
-        self.core.digital_write(pin, value)
+        self._queue_write(pin, self.core.digital_write, value)
 
-    async def digital_write(self, command):
+    async def digital_write(self, session, command):
         """
         This method writes a zero or one to a digital pin.
 
@@ -168,9 +555,9 @@ class WildServer:
         """
         pin = int(command[0])
         value = int(command[1])
-        self.core.digital_write(pin, value)
+        self._queue_write(pin, self.core.digital_write, value)
 
-    async def disable_analog_reporting(self, command):
+    async def disable_analog_reporting(self, session, command):
         """
         Disable Firmata reporting for an analog pin.
 
@@ -180,7 +567,7 @@ class WildServer:
         pin = int(command[0])
         await self.core.disable_analog_reporting(pin)
 
-    async def disable_digital_reporting(self, command):
+    async def disable_digital_reporting(self, session, command):
         """
         Disable Firmata reporting for a digital pin.
 
@@ -190,7 +577,7 @@ class WildServer:
         pin = int(command[0])
         await self.core.disable_digital_reporting(pin)
 
-    async def enable_analog_reporting(self, command):
+    async def enable_analog_reporting(self, session, command):
         """
         Enable Firmata reporting for an analog pin.
 
@@ -200,7 +587,7 @@ class WildServer:
         pin = int(command[0])
         await self.core.enable_analog_reporting(pin)
 
-    async def enable_digital_reporting(self, command):
+    async def enable_digital_reporting(self, session, command):
         """
         Enable Firmata reporting for a digital pin.
 
@@ -210,7 +597,7 @@ class WildServer:
         pin = int(command[0])
         await self.core.enable_digital_reporting(pin)
 
-    async def encoder_config(self, command):
+    async def encoder_config(self, session, command):
         """
         Configure 2 pins for FirmataPlus encoder operation.
 
@@ -219,9 +606,14 @@ class WildServer:
         """
         pin_a = int(command[0])
         pin_b = int(command[1])
-        await self.core.encoder_config(pin_a, pin_b, self.encoder_callback)
+        self._subscribe(session, "encoder", pin_a)
+
+        def callback(data):
+            self.encoder_callback(data, pin_a)
 
-    async def encoder_read(self, command):
+        await self.core.encoder_config(pin_a, pin_b, callback)
+
+    async def encoder_read(self, session, command):
         """
         This is a polling method to read the last cached FirmataPlus encoder value.
         Normally not used. See encoder config for the asynchronous report message format.
@@ -231,10 +623,9 @@ class WildServer:
         """
         pin = int(command[0])
         val = await self.core.encoder_read(pin)
-        reply = json.dumps({"method": "encoder_read_reply", "params": [pin, val]})
-        await self.websocket.send(reply)
+        await self._send_reply(session, "encoder_read_reply", [pin, val])
 
-    async def get_analog_latch_data(self, command):
+    async def get_analog_latch_data(self, session, command):
         """
         This method retrieves a latch table entry for an analog pin.
 
@@ -248,10 +639,9 @@ class WildServer:
         data_val = await self.core.get_analog_latch_data(pin)
         if data_val:
             data_val = data_val[0:-1]
-        reply = json.dumps({"method": "get_analog_latch_data_reply", "params": [pin, data_val]})
-        await self.websocket.send(reply)
+        await self._send_reply(session, "get_analog_latch_data_reply", [pin, data_val])
 
-    async def get_analog_map(self):
+    async def get_analog_map(self, session):
         """
         This method retrieves the Firmata analog map.
 
@@ -262,12 +652,11 @@ class WildServer:
         """
         value = await self.core.get_analog_map()
         if value:
-            reply = json.dumps({"method": "analog_map_reply", "params": value})
+            await self._send_reply(session, "analog_map_reply", value)
         else:
-            reply = json.dumps({"method": "analog_map_reply", "params": "None"})
-        await self.websocket.send(reply)
+            await self._send_reply(session, "analog_map_reply", "None")
 
-    async def get_capability_report(self):
+    async def get_capability_report(self, session):
         """
         This method retrieves the Firmata capability report.
 
@@ -278,14 +667,12 @@ class WildServer:
         :returns: {"method": "capability_report_reply", "params": [RAW_CAPABILITY_REPORT]}
         """
         value = await self.core.get_capability_report()
-        await asyncio.sleep(.1)
         if value:
-            reply = json.dumps({"method": "capability_report_reply", "params": value})
+            await self._send_reply(session, "capability_report_reply", value)
         else:
-            reply = json.dumps({"method": "capability_report_reply", "params": "None"})
-        await self.websocket.send(reply)
+            await self._send_reply(session, "capability_report_reply", "None")
 
-    async def get_digital_latch_data(self, command):
+    async def get_digital_latch_data(self, session, command):
         """
         This method retrieves a latch table entry for a digital pin.
 
@@ -299,10 +686,9 @@ class WildServer:
         data_val = await self.core.get_digital_latch_data(pin)
         if data_val:
             data_val = data_val[0:-1]
-        reply = json.dumps({"method": "get_digital_latch_data_reply", "params": [pin, data_val]})
-        await self.websocket.send(reply)
+        await self._send_reply(session, "get_digital_latch_data_reply", [pin, data_val])
 
-    async def get_firmware_version(self):
+    async def get_firmware_version(self, session):
         """
         This method retrieves the Firmata firmware version.
 
@@ -315,12 +701,11 @@ class WildServer:
         """
         value = await self.core.get_firmware_version()
         if value:
-            reply = json.dumps({"method": "firmware_version_reply", "params": value})
+            await self._send_reply(session, "firmware_version_reply", value)
         else:
-            reply = json.dumps({"method": "firmware_version_reply", "params": "Unknown"})
-        await self.websocket.send(reply)
+            await self._send_reply(session, "firmware_version_reply", "Unknown")
 
-    async def get_pinstate_report(self, command):
+    async def get_pinstate_report(self, session, command):
         """
         This method retrieves a Firmata pin_state report for a pin..
 
@@ -332,12 +717,11 @@ class WildServer:
         pin = int(command[0])
         value = await self.core.get_pin_state(pin)
         if value:
-            reply = json.dumps({"method": "pin_state_reply", "params": value})
+            await self._send_reply(session, "pin_state_reply", value)
         else:
-            reply = json.dumps({"method": "pin_state_reply", "params": "Unknown"})
-        await self.websocket.send(reply)
+            await self._send_reply(session, "pin_state_reply", "Unknown")
 
-    async def get_protocol_version(self):
+    async def get_protocol_version(self, session):
         """
         This method retrieves the Firmata protocol version.
 
@@ -347,12 +731,27 @@ class WildServer:
         """
         value = await self.core.get_protocol_version()
         if value:
-            reply = json.dumps({"method": "protocol_version_reply", "params": value})
+            await self._send_reply(session, "protocol_version_reply", value)
         else:
-            reply = json.dumps({"method": "protocol_version_reply", "params": "Unknown"})
-        await self.websocket.send(reply)
+            await self._send_reply(session, "protocol_version_reply", "Unknown")
+
+    async def get_snapshot(self, session):
+        """
+        This method returns the cached state of the board in one message: pin modes and
+        values, analog values, latch table entries, and the latest sonar, encoder and
+        i2c data. Nothing is sent to the board, so this is much cheaper than reading
+        every pin. If the server was started with snapshot_on_connect, every new
+        connection receives this message first.
+
+        JSON command: {"method": "get_snapshot", "params": ["null"]}
+
+        :returns: {"method": "snapshot_reply", "params": [SNAPSHOT]}
+                  See WildcardsFirmata.get_snapshot for the layout of SNAPSHOT.
+        """
+        self._apply_pending_writes()
+        await self._send_reply(session, "snapshot_reply", [self.core.get_snapshot()])
 
-    async def get_wildcards_version(self):
+    async def get_wildcards_version(self, session):
         """
          This method retrieves the Wildcards release version number.
 
@@ -362,12 +761,11 @@ class WildServer:
         """
         value = await self.core.get_wildcards_version()
         if value:
-            reply = json.dumps({"method": "wildcards_version_reply", "params": value})
+            await self._send_reply(session, "wildcards_version_reply", value)
         else:
-            reply = json.dumps({"method": "wildcards_version_reply", "params": "Unknown"})
-        await self.websocket.send(reply)
+            await self._send_reply(session, "wildcards_version_reply", "Unknown")
 
-    async def i2c_config(self, command):
+    async def i2c_config(self, session, command):
         """
         This method initializes the I2c and sets the optional read delay (in microseconds).
 
@@ -378,7 +776,7 @@ class WildServer:
         delay = int(command[0])
         await self.core.i2c_config(delay)
 
-    async def i2c_read_data(self, command):
+    async def i2c_read_data(self, session, command):
         """
         This method retrieves the last value read for an i2c device identified by address.
         This is a polling implementation and i2c_read_request and i2c_read_request_reply may be
@@ -388,10 +786,9 @@ class WildServer:
         """
         address = int(command[0])
         i2c_data = await self.core.i2c_read_data(address)
-        reply = json.dumps({"method": "i2c_read_data_reply", "params": i2c_data})
-        await self.websocket.send(reply)
+        await self._send_reply(session, "i2c_read_data_reply", i2c_data)
 
-    async def i2c_read_request(self, command):
+    async def i2c_read_request(self, session, command):
         """
         This method sends an I2C read request to Firmata. It is qualified by a single shot, continuous
         read, or stop reading command.
@@ -426,10 +823,11 @@ class WildServer:
         else:  # the default case stop reading valid request or invalid request
             read_type = Constants.I2C_STOP_READING
 
+        self._subscribe(session, "i2c", device_address)
         await self.core.i2c_read_request(device_address, register, number_of_bytes, read_type,
                                          self.i2c_read_request_callback)
 
-    async def i2c_write_request(self, command):
+    async def i2c_write_request(self, session, command):
         """
         This method performs an I2C write at a given I2C address,
         :param command: {"method": "i2c_write_request", "params": [I2C_DEVICE_ADDRESS, [DATA_TO_WRITE]]}
@@ -440,7 +838,7 @@ class WildServer:
         params = [int(i) for i in params]
         await self.core.i2c_write_request(device_address, params)
 
-    async def keep_alive(self, command):
+    async def keep_alive(self, session, command):
         """
         Periodically send a keep alive message to the Arduino.
         Frequency of keep alive transmission is calculated as follows:
@@ -455,7 +853,7 @@ class WildServer:
         margin = int(command[1])
         await self.core.keep_alive(period, margin)
 
-    async def play_tone(self, command):
+    async def play_tone(self, session, command):
         """
         This method controls a piezo device to play a tone. It is a FirmataPlus feature.
         Tone command is TONE_TONE to play, TONE_NO_TONE to stop playing.
@@ -471,7 +869,7 @@ class WildServer:
         duration = int(command[3])
         await self.core.play_tone(pin, tone_command, frequency, duration)
 
-    async def set_analog_latch(self, command):
+    async def set_analog_latch(self, session, command):
         """
         This method sets the an analog latch for a given analog pin, providing the threshold type, and
         latching threshold.
@@ -481,9 +879,10 @@ class WildServer:
         pin = int(command[0])
         threshold_type = int(command[1])
         threshold_value = int(command[2])
+        self._subscribe(session, "latch", 'A' + str(pin))
         await self.core.set_analog_latch(pin, threshold_type, threshold_value, self.analog_latch_callback)
 
-    async def set_digital_latch(self, command):
+    async def set_digital_latch(self, session, command):
         """
         This method sets the a digital latch for a given digital pin, the threshold type, and latching threshold.
         :param command:{"method": "set_digital_latch", "params": [PIN, THRESHOLD (0 or 1)]}
@@ -491,9 +890,10 @@ class WildServer:
         """
         pin = int(command[0])
         threshold_value = int(command[1])
+        self._subscribe(session, "latch", 'D' + str(pin))
         await self.core.set_digital_latch(pin, threshold_value, self.digital_latch_callback)
 
-    async def set_pin_mode(self, command):
+    async def set_pin_mode(self, session, command):
         """
         This method sets the pin mode for the selected pin. It handles: Input, Analog(Input) PWM, and OUTPUT. Servo
         is handled by servo_config().
@@ -504,14 +904,18 @@ class WildServer:
         mode = int(command[1])
         if mode == Constants.INPUT:
             cb = self.digital_callback
+            self._subscribe(session, "digital", pin)
         elif mode == Constants.ANALOG:
             cb = self.analog_callback
+            analog_pin = self.core.analog_pin_number(pin)
+            if analog_pin is not None:
+                self._subscribe(session, "analog", analog_pin)
         else:
             cb = None
 
         await self.core.set_pin_mode(pin, mode, cb)
 
-    async def set_sampling_interval(self, command):
+    async def set_sampling_interval(self, session, command):
         """
         This method sets the Firmata sampling interval in ms.
         :param command:{"method": "set_sampling_interval", "params": [INTERVAL]}
@@ -520,7 +924,7 @@ class WildServer:
         sample_interval = int(command[0])
         await self.core.set_sampling_interval(sample_interval)
 
-    async def sonar_config(self, command):
+    async def sonar_config(self, session, command):
         """
         This method configures 2 pins to support HC-SR04 Ping devices.
         This is a FirmataPlus feature.
@@ -532,9 +936,10 @@ class WildServer:
         echo = int(command[1])
         interval = int(command[2])
         max_dist = int(command[3])
+        self._subscribe(session, "sonar", trigger)
         await self.core.sonar_config(trigger, echo, self.sonar_callback, interval, max_dist)
 
-    async def sonar_read(self, command):
+    async def sonar_read(self, session, command):
         """
         This method retrieves the last sonar data value that was cached.
         This is a polling method. After sonar config, sonar_data_reply messages will be sent automatically.
@@ -544,10 +949,9 @@ class WildServer:
         pin = int(command[0])
         val = await self.core.sonar_data_retrieve(pin)
 
-        reply = json.dumps({"method": "sonar_read_reply", "params": [pin, val]})
-        await self.websocket.send(reply)
+        await self._send_reply(session, "sonar_read_reply", [pin, val])
 
-    async def servo_config(self, command):
+    async def servo_config(self, session, command):
         """
         This method configures a pin for servo operation. The servo angle is set by using analog_write().
         :param command: {"method": "servo_config", "params": [PIN, MINIMUM_PULSE(ms), MAXIMUM_PULSE(ms)]}
@@ -558,7 +962,7 @@ class WildServer:
         max_pulse = int(command[2])
         await self.core.servo_config(pin, min_pulse, max_pulse)
 
-    async def stepper_config(self, command):
+    async def stepper_config(self, session, command):
         """
         This method configures 4 pins for stepper motor operation.
         This is a FirmataPlus feature.
@@ -573,7 +977,7 @@ class WildServer:
         pin4 = int(pins[3])
         await self.core.stepper_config(steps_per_revs, [pin1, pin2, pin3, pin4])
 
-    async def stepper_step(self, command):
+    async def stepper_step(self, session, command):
         """
         This method activates a stepper motor motion.
         This is a FirmataPlus feature.
@@ -584,15 +988,113 @@ class WildServer:
         num_steps = int(command[1])
         await self.core.stepper_step(speed, num_steps)
 
+    async def get_connection_stats(self, session):
+        """
+        This method returns the outbound queue counters of every open connection,
+        for monitoring slow clients.
+        :returns: {"method": "connection_stats_reply", "params": [{"session": ID, "queue_depth": N,
+                   "max_queue_depth": N, "sent": N, "dropped": N, "superseded": N}, ...]}
+        """
+        stats = [s.get_stats() for s in sorted(self.sessions, key=lambda s: s.session_id)]
+        await self._send_reply(session, "connection_stats_reply", stats)
+
+    async def set_tracing(self, session, command):
+        """
+        This method turns command latency tracing on or off for all clients. While it is
+        on, each command records the time it reaches each stage of its trip to the board.
+        Turning tracing on clears the traces collected before.
+
+        :param command: {"method": "set_tracing", "params": [1 (on) or 0 (off)]}
+        :returns: No return message.
+        """
+        enabled = bool(int(command[0]))
+        if enabled:
+            Tracing.TRACER.clear()
+        Tracing.TRACER.enable(enabled)
+
+    async def get_trace_summary(self, session):
+        """
+        This method returns the 50th and 99th percentile time, in ms, from receiving a
+        command to each stage: serial_write (a query or sysex message was written),
+        reply (the board's reply was dispatched), handler_done, frame (the frame with the
+        command's pin updates was built) and frame_written.
+
+        JSON command: {"method": "get_trace_summary", "params": ["null"]}
+
+        :returns: {"method": "trace_summary_reply", "params": [{STAGE: {"count": N, "p50": MS,
+                   "p99": MS}, ...}]}
+        """
+        await self._send_reply(session, "trace_summary_reply", [Tracing.TRACER.summary()])
+
+    async def get_traces(self, session):
+        """
+        This method returns the collected traces, oldest first.
+
+        JSON command: {"method": "get_traces", "params": ["null"]}
+
+        :returns: {"method": "traces_reply", "params": [{"id": N, "method": METHOD, "start": SECONDS,
+                   "stages": [[STAGE, MS], ...]}, ...]}
+        """
+        await self._send_reply(session, "traces_reply", Tracing.TRACER.traces())
+
+    async def set_batching(self, session, command):
+        """
+        This method turns notification batching on or off for the client.
+        While batching is on, analog, digital, encoder and sonar notifications are
+        gathered for WINDOW ms and sent together in a single batch_reply frame, keeping
+        only the latest value for each pin. Latch and i2c notifications are not batched.
+        A WINDOW of 0 turns batching off.
+
+        :param command: {"method": "set_batching", "params": [WINDOW]}
+        :returns: {"method": "batch_reply", "params": [[METHOD, PARAMS], ...]} once per window
+        """
+        window = max(int(command[0]), 0)
+        session.set_batch_window(window / 1000)
+
+    async def subscribe(self, session, command):
+        """
+        This method subscribes the client to notifications for one pin, sonar trigger pin,
+        encoder, i2c address or latch. Notifications are only sent to subscribed clients.
+        set_pin_mode, sonar_config, encoder_config, i2c_read_request and the latch methods
+        subscribe the requesting client automatically.
+
+        KIND is one of "analog" (analog pin number, as in analog_message_reply), "digital" (pin),
+        "sonar" (trigger pin), "encoder" (pin A), "i2c" (device address) or "latch" ("A" or "D"
+        followed by the pin number, e.g. "A3").
+
+        For analog, digital, sonar and encoder subscriptions, the optional OPTIONS limit what
+        is sent: "max_rate" caps the updates per second (the latest value is always delivered
+        eventually), "deadband" skips changes of at most that amount from the last value sent,
+        and "deadband_percent" skips changes of at most that percentage of the last value sent.
+        Subscribing again replaces the options; subscribing without OPTIONS keeps them.
+
+        :param command: {"method": "subscribe", "params": [KIND, ID, OPTIONS]}
+        :returns: No return message.
+        """
+        kind = command[0]
+        options = command[2] if len(command) > 2 else None
+        self._subscribe(session, kind, self._subscription_key(kind, command[1]), options)
+
+    async def unsubscribe(self, session, command):
+        """
+        This method stops notifications previously requested with subscribe.
+
+        :param command: {"method": "unsubscribe", "params": [KIND, ID]}
+        :returns: No return message.
+        """
+        kind = command[0]
+        self._unsubscribe(session, kind, self._subscription_key(kind, command[1]))
+
+    @_timed_callback
     def analog_callback(self, data):
         """
         This method handles the analog message received from Wildcards Firmata
         :param data: analog callback message
         :returns:{"method": "analog_message_reply", "params": [PIN, DATA_VALUE}
         """
-        reply = json.dumps({"method": "analog_message_reply", "params": [data[0], data[1]]})
-        asyncio.ensure_future(self.websocket.send(reply))
+        self._notify("analog", data[0], "analog_message_reply", [data[0], data[1]])
 
+    @_timed_callback
     def analog_latch_callback(self, data):
         """
         This method handles analog_latch data received from Wildcards Firmata
@@ -601,19 +1103,19 @@ class WildServer:
         """
         ts = data[2]
         st = datetime.datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S')
-        reply = json.dumps({"method": "analog_latch_data_reply", "params": [data[0], data[1], st]})
-        asyncio.ensure_future(self.websocket.send(reply))
+        self._notify("latch", data[0], "analog_latch_data_reply", [data[0], data[1], st])
 
+    @_timed_callback
     def digital_callback(self, data):
         """
         This method handles the digital message received from Wildcards Firmata
         :param data: digital callback message
         :returns:{"method": "digital_message_reply", "params": [PIN, DATA_VALUE]}
         """
-        logstring("sending digital message reply {}".format(data))
-        reply = json.dumps({"method": "digital_message_reply", "params": [data[0], data[1]]})
-        asyncio.ensure_future(self.websocket.send(reply))
+        logdebug("sending digital message reply {}", data)
+        self._notify("digital", data[0], "digital_message_reply", [data[0], data[1]])
 
+    @_timed_callback
     def digital_latch_callback(self, data):
         """
         This method handles the digital latch data message received from Wildcards Firmata
@@ -622,41 +1124,43 @@ class WildServer:
         """
         ts = data[2]
         st = datetime.datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S')
-        reply = json.dumps({"method": "digital_latch_data_reply", "params": [data[0], data[1], st]})
-        asyncio.ensure_future(self.websocket.send(reply))
+        self._notify("latch", data[0], "digital_latch_data_reply", [data[0], data[1], st])
 
-    def encoder_callback(self, data):
+    @_timed_callback
+    def encoder_callback(self, data, pin_a):
         """
         This method handles the encoder data message received from Wildcards Firmata
         :param data: encoder data callback message
+        :param pin_a: encoder pin A, which identifies the encoder
         :returns:{"method": "encoder_data_reply", "params": [ENCODER VALUE]}
         """
-        reply = json.dumps({"method": "encoder_data_reply", "params": data})
-        asyncio.ensure_future(self.websocket.send(reply))
+        self._notify("encoder", pin_a, "encoder_data_reply", data)
 
+    @_timed_callback
     def i2c_read_request_callback(self, data):
         """
         This method handles the i2c read data message received from Wildcards Firmata.
         :param data: i2c read data callback message
         :returns:{"method": "i2c_read_request_reply", "params": [DATA_VALUE]}
         """
-        reply = json.dumps({"method": "i2c_read_request_reply", "params": data})
-        asyncio.ensure_future(self.websocket.send(reply))
+        # the first value in the reply is the device address
+        self._notify("i2c", data[0], "i2c_read_request_reply", data)
 
+    @_timed_callback
     def i2c_read_data_callback(self, data):
         """
         This method handles the i2c cached read data received from Wildcards Firmata.
         :param data: i2c read cached data callback message
         :returns:{"method": "i2c_read_data_reply", "params": [DATA_VALUE]}
         """
-        reply = json.dumps({"method": "i2c_read_data_reply", "params": data})
-        asyncio.ensure_future(self.websocket.send(reply))
+        self._broadcast("i2c_read_data_reply", data)
 
+    @_timed_callback
     def sonar_callback(self, data):
         """
         This method handles sonar data received from Wildcards Firmata.
         :param data: sonar data callback message
         :returns:{"method": "sonar_data_reply", "params": [DATA_VALUE]}
         """
-        reply = json.dumps({"method": "sonar_data_reply", "params": data})
-        asyncio.ensure_future(self.websocket.send(reply))
+        # the first value in the reply is the trigger pin
+        self._notify("sonar", data[0], "sonar_data_reply", data)
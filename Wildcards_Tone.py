@@ -46,6 +46,7 @@ class Tone(WildcardsFirmataBaseObject):
             self._frequency = round_decimal(frequency)
             self._duration = round_decimal(duration)
             self._playtone = True
+            self._mark_dirty()
     #presently, FirmataPlus doesn't track that tone() changes
     #the pin mode to output. This may be an area for future 
     #improvement
@@ -60,6 +61,7 @@ class Tone(WildcardsFirmataBaseObject):
                 self._stoptone = True
                 self._playtone = False #if stop tone was called, then don't play a tone
                                        #unless play_tone is called specifically afterwards
+                self._mark_dirty()
 
     @property
     def pin_number(self):
@@ -90,15 +92,15 @@ class Tone(WildcardsFirmataBaseObject):
         return self._stoptone or self._playtone   
     
     def generate_byte_string(self):
-        output = ""
+        output = b""
         if self._stoptone == True:
-            output += WrapSysEx(chr(PrivateConstants.TONE_DATA) + 
-                                chr(Constants.TONE_NO_TONE) +
+            output += WrapSysEx(bytes([PrivateConstants.TONE_DATA]) + 
+                                bytes([Constants.TONE_NO_TONE]) +
                                 To7BitBytes(self._pin_number))
             self._stoptone = False
         if self._playtone == True:
-            output += WrapSysEx(chr(PrivateConstants.TONE_DATA) + 
-                                chr(Constants.TONE_TONE) +
+            output += WrapSysEx(bytes([PrivateConstants.TONE_DATA]) + 
+                                bytes([Constants.TONE_TONE]) +
                                 To7BitBytes(self._pin_number) + 
                                 To7BitBytes(self._frequency, 2) +   
                                 To7BitBytes(self._duration, 2)) 
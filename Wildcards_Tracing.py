@@ -0,0 +1,211 @@
+"""
+ Copyright (c) 2018 Dynamic Phase, LLC All rights reserved.
+
+ This program is free software; you can redistribute it and/or
+ modify it under the terms of the GNU AFFERO GENERAL PUBLIC LICENSE
+ Version 3 as published by the Free Software Foundation; either
+ or (at your option) any later version.
+ This library is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ General Public License for more details.
+
+ You should have received a copy of the GNU AFFERO GENERAL PUBLIC LICENSE
+ along with this library; if not, write to the Free Software
+ Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+"""
+
+import collections
+import contextvars
+import math
+import time
+
+from Wildcards_Logger import *
+
+# Optional latency tracing of websocket commands through the link.
+#
+# A trace records time.monotonic() at each stage a command passes:
+#
+#     receive        the websocket frame was received
+#     serial_write   a message the handler sent directly (queries, sysex
+#                    commands) was written to the serial port
+#     reply          the board's reply to a query was dispatched
+#     handler_done   the command handler finished
+#     frame          write_continuously built the frame carrying the
+#                    command's pin updates
+#     frame_written  that frame was written to the serial port
+#
+# Commands that leave output for write_continuously wait for the next frame
+# before their trace is complete, or until frame_timeout has passed. Completed
+# traces are kept in a bounded buffer that can be read back and summarized per
+# stage.
+
+RECEIVE = "receive"
+SERIAL_WRITE = "serial_write"
+REPLY = "reply"
+HANDLER_DONE = "handler_done"
+FRAME = "frame"
+FRAME_WRITTEN = "frame_written"
+
+STAGES = (SERIAL_WRITE, REPLY, HANDLER_DONE, FRAME, FRAME_WRITTEN)
+
+# the trace of the command being handled, for stages recorded deep in the firmata core
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+class Trace:
+    __slots__ = ("trace_id", "method", "stages")
+
+    def __init__(self, trace_id, method, received):
+        self.trace_id = trace_id
+        self.method = method
+        self.stages = [(RECEIVE, received)]
+
+    def mark(self, stage, timestamp=None):
+        self.stages.append((stage, time.monotonic() if timestamp is None else timestamp))
+
+    def as_dict(self):
+        start = self.stages[0][1]
+        return {"id": self.trace_id,
+                "method": self.method,
+                "start": start,
+                # milliseconds since the command was received
+                "stages": [[stage, round((timestamp - start) * 1000, 3)] for stage, timestamp in self.stages]}
+
+
+class Tracer:
+    """
+    Collects command traces. Does nothing while disabled.
+    """
+
+    def __init__(self, capacity=1000, frame_timeout=5.0):
+        """
+        :param capacity: number of completed traces kept
+        :param frame_timeout: seconds a trace waits for its output frame before
+                              it is completed without one
+        """
+        self.enabled = False
+        self.frame_timeout = frame_timeout
+        self._next_id = 1
+        self._completed = collections.deque(maxlen=capacity)
+        # traces waiting for the next frame, and those whose frame is being written
+        self._awaiting_frame = collections.deque(maxlen=capacity)
+        self._in_frame = []
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+        if not enabled:
+            # keep what was collected, without the stages that won't come now
+            self._completed.extend(self._awaiting_frame)
+            self._completed.extend(self._in_frame)
+            self._awaiting_frame.clear()
+            self._in_frame = []
+        logstring("Command tracing {}".format("enabled" if enabled else "disabled"))
+
+    def clear(self):
+        self._completed.clear()
+
+    def start(self, method, received):
+        """
+        :param method: command method name
+        :param received: time.monotonic() when the command arrived
+        :returns: a new Trace, or None while tracing is disabled
+        """
+        if not self.enabled:
+            return None
+        trace = Trace(self._next_id, method, received)
+        self._next_id += 1
+        return trace
+
+    def handler_done(self, trace, output_pending):
+        """
+        Records the end of the command handler
+
+        :param output_pending: the command left pin updates for write_continuously,
+                               so the trace continues until they are written
+        """
+        now = time.monotonic()
+        trace.mark(HANDLER_DONE, now)
+        if output_pending and self.enabled:
+            self._awaiting_frame.append(trace)
+            self._expire(now)
+        else:
+            self._completed.append(trace)
+
+    def _expire(self, now):
+        # traces whose frame never came are completed without one
+        while self._awaiting_frame and now - self._awaiting_frame[0].stages[0][1] > self.frame_timeout:
+            self._completed.append(self._awaiting_frame.popleft())
+
+    def frame_generated(self):
+        """
+        Called by write_continuously once it has built a frame
+        """
+        if not self._awaiting_frame:
+            return
+        now = time.monotonic()
+        for trace in self._awaiting_frame:
+            trace.mark(FRAME, now)
+        self._in_frame.extend(self._awaiting_frame)
+        self._awaiting_frame.clear()
+
+    def frame_written(self):
+        """
+        Called by write_continuously once the frame has been written
+        """
+        if not self._in_frame:
+            return
+        now = time.monotonic()
+        for trace in self._in_frame:
+            trace.mark(FRAME_WRITTEN, now)
+            self._completed.append(trace)
+        self._in_frame = []
+
+    def traces(self):
+        """
+        :returns: completed traces, oldest first, as dictionaries
+        """
+        self._expire(time.monotonic())
+        return [trace.as_dict() for trace in self._completed]
+
+    def summary(self):
+        """
+        :returns: {stage: {"count": N, "p50": MS, "p99": MS}} giving the time from
+                  receive to each stage, over the completed traces
+        """
+        self._expire(time.monotonic())
+        latencies = {stage: [] for stage in STAGES}
+        for trace in self._completed:
+            start = trace.stages[0][1]
+            seen = set()
+            for stage, timestamp in trace.stages[1:]:
+                # a command may write several messages; the first one counts
+                if stage not in seen:
+                    seen.add(stage)
+                    latencies[stage].append((timestamp - start) * 1000)
+        result = {}
+        for stage, values in latencies.items():
+            if values:
+                values.sort()
+                result[stage] = {"count": len(values),
+                                 "p50": round(_percentile(values, 50), 3),
+                                 "p99": round(_percentile(values, 99), 3)}
+        return result
+
+
+def _percentile(sorted_values, percent):
+    # nearest rank
+    index = max(0, math.ceil(percent / 100 * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+
+def mark_current(stage):
+    """
+    Records a stage on the trace of the command being handled, if any
+    """
+    trace = current_trace.get()
+    if trace is not None:
+        trace.mark(stage)
+
+
+TRACER = Tracer()
@@ -0,0 +1,182 @@
+"""
+ Copyright (c) 2018 Dynamic Phase, LLC All rights reserved.
+
+ This program is free software; you can redistribute it and/or
+ modify it under the terms of the GNU AFFERO GENERAL PUBLIC LICENSE
+ Version 3 as published by the Free Software Foundation; either
+ or (at your option) any later version.
+ This library is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ General Public License for more details.
+
+ You should have received a copy of the GNU AFFERO GENERAL PUBLIC LICENSE
+ along with this library; if not, write to the Free Software
+ Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+"""
+
+import asyncio
+import inspect
+import sys
+import threading
+import time
+import traceback
+
+from Wildcards_Logger import *
+import Wildcards_Metrics as Metrics
+
+# Watches the health of the event loop.
+#
+# A heartbeat task sleeps for a fixed interval and measures how late it
+# wakes up; that lag is how long everything else on the loop waits too.
+# A monitor thread checks the heartbeat, and when the loop has not run for
+# longer than the threshold it captures the stack of the loop thread, which
+# shows the call that is blocking it, e.g. a time.sleep() or a slow write.
+#
+# The heartbeat also counts live tasks by coroutine name, so a leak such as
+# a task started per connection and never finished shows up as a growing
+# count.
+
+
+_COROUTINE_FLAGS = inspect.CO_COROUTINE | inspect.CO_ITERABLE_COROUTINE
+
+
+def _frame_task_name(frame):
+    """
+    :returns: name of the outermost coroutine on the stack ending at frame,
+              which is the coroutine of the running task; None outside a task
+    """
+    name = None
+    while frame is not None:
+        code = frame.f_code
+        if code.co_flags & _COROUTINE_FLAGS:
+            name = getattr(code, "co_qualname", code.co_name)
+        frame = frame.f_back
+    return name
+
+
+def _task_name(task):
+    coro = task.get_coro() if hasattr(task, "get_coro") else getattr(task, "_coro", None)
+    name = getattr(coro, "__qualname__", None)
+    if name is None:
+        name = type(coro).__name__
+    return name
+
+
+class Watchdog:
+    def __init__(self, interval=0.1, threshold=0.25, task_interval=10.0):
+        """
+        :param interval: seconds between heartbeats
+        :param threshold: seconds the loop may go without running before it is
+                          reported as stalled
+        :param task_interval: seconds between counts of the live tasks
+        """
+        self.interval = interval
+        self.threshold = threshold
+        self.task_interval = task_interval
+        self.loop = None
+        self.stalls = 0
+        self.max_lag = 0.0
+        # the most recent stall seen by the monitor thread: {"detected", "task", "stack"}
+        self.last_stall = None
+        self._last_beat = None
+        self._stall_beat = None
+        self._loop_thread_id = None
+        self._task_names = set()
+        self._task = None
+        self._thread = None
+        self._stop_event = threading.Event()
+        self._running = False
+
+    def start(self, loop=None):
+        """
+        Starts the heartbeat task and the monitor thread
+        """
+        if self._running:
+            return
+        self.loop = loop or asyncio.get_event_loop()
+        self._running = True
+        self._stop_event.clear()
+        self._last_beat = time.monotonic()
+        self._task = self.loop.create_task(self._heartbeat())
+        self._thread = threading.Thread(target=self._monitor, name="Wildcards watchdog", daemon=True)
+        self._thread.start()
+        logstring("Event loop watchdog started, stall threshold {:.0f} ms".format(self.threshold * 1000))
+
+    def stop(self):
+        """
+        Stops the heartbeat task and waits for the monitor thread to finish.
+        Call this before stopping the loop, or the monitor reports it as stalled.
+        """
+        self._running = False
+        self._stop_event.set()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    async def _heartbeat(self):
+        self._loop_thread_id = threading.get_ident()
+        next_task_count = time.monotonic()
+        while self._running:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0.0, now - expected)
+            self._last_beat = now
+            Metrics.EVENT_LOOP_LAG_SECONDS.observe(lag)
+            if lag > self.max_lag:
+                self.max_lag = lag
+            if lag > self.threshold:
+                self.stalls += 1
+                Metrics.EVENT_LOOP_STALLS.inc()
+                logstring("Event loop was blocked for {:.0f} ms".format(lag * 1000))
+            if now >= next_task_count:
+                self.count_tasks()
+                next_task_count = now + self.task_interval
+
+    def count_tasks(self):
+        """
+        Updates the live task gauges
+
+        :returns: dictionary of coroutine name to number of live tasks
+        """
+        counts = {}
+        for task in asyncio.all_tasks(self.loop):
+            if not task.done():
+                name = _task_name(task)
+                counts[name] = counts.get(name, 0) + 1
+        # names that are gone report zero rather than their last count
+        for name in self._task_names - counts.keys():
+            Metrics.TASKS.labels(name).set(0)
+        for name, count in counts.items():
+            Metrics.TASKS.labels(name).set(count)
+        self._task_names = set(counts)
+        logdebug("{} live tasks: {}", sum(counts.values()),
+                 ", ".join("{} x{}".format(name, count) for name, count in sorted(counts.items())))
+        return counts
+
+    def _monitor(self):
+        # runs on its own thread, so it still works while the loop is blocked
+        while not self._stop_event.wait(self.threshold / 2):
+            last_beat = self._last_beat
+            if time.monotonic() - last_beat > self.interval + self.threshold and self._stall_beat != last_beat:
+                self._stall_beat = last_beat
+                self._capture_stall()
+
+    def _capture_stall(self):
+        frame = sys._current_frames().get(self._loop_thread_id)
+        if frame is None:
+            return
+        stack = "".join(traceback.format_stack(frame))
+        # taken from the captured frames; the loop's own task bookkeeping
+        # isn't safe to read from this thread
+        task_name = _frame_task_name(frame)
+        if task_name is None:
+            # a plain callback, such as a reader
+            task_name = "(callback)"
+        self.last_stall = {"detected": time.time(), "task": task_name, "stack": stack}
+        logstring("Event loop has not run for over {:.0f} ms, held by {}:\n{}".format(
+            (self.interval + self.threshold) * 1000, task_name, stack))
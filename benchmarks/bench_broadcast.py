@@ -0,0 +1,153 @@
+"""
+ Copyright (c) 2018 Dynamic Phase, LLC All rights reserved.
+
+ This program is free software; you can redistribute it and/or
+ modify it under the terms of the GNU AFFERO GENERAL PUBLIC LICENSE
+ Version 3 as published by the Free Software Foundation; either
+ or (at your option) any later version.
+ This library is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ General Public License for more details.
+
+ You should have received a copy of the GNU AFFERO GENERAL PUBLIC LICENSE
+ along with this library; if not, write to the Free Software
+ Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+"""
+
+"""
+Measures the server side cost of fanning analog notifications out to
+websocket clients, for 1 to 50 connected clients, and checks that each
+notification is encoded once however many clients receive it.
+
+No board or browser is needed: the clients are ClientSessions on top of
+connections that discard what they are sent. Each one subscribes with the
+subscribe command, as a browser would, and the notifications are fed
+straight into WildServer.analog_callback.
+
+By default the subscriptions carry a zero deadband, which sets up a
+SubscriptionFilter that passes every change, so its cost is included;
+--unfiltered subscribes without options.
+
+Run from the repository root:
+
+    python benchmarks/bench_broadcast.py [--notifications N] [--binary] [--unfiltered]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from constants import Constants
+from Wildcards_ClientSession import ClientSession
+import Wildcards_BinaryProtocol as BinaryProtocol
+from Wildcards_Server import WildServer
+
+
+class NullConnection:
+    """
+    Stands in for a websocket connection and throws away everything sent
+    """
+
+    def __init__(self, subprotocol=None):
+        self.subprotocol = subprotocol
+        self.frames = 0
+
+    async def send(self, message):
+        self.frames += 1
+
+
+class NullCore:
+    """
+    The only part of WildcardsFirmata that WildServer needs for notifications
+    """
+
+    def add_pre_flush_hook(self, hook):
+        pass
+
+    def request_flush(self):
+        pass
+
+
+class EncodeCounter:
+    """
+    Counts the calls to the JSON and binary encoders while installed
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self._originals = None
+
+    def _wrap(self, function):
+        def counted(*args, **kwargs):
+            self.calls += 1
+            return function(*args, **kwargs)
+        return counted
+
+    def __enter__(self):
+        self._originals = (json.dumps, BinaryProtocol.encode_reply)
+        json.dumps = self._wrap(json.dumps)
+        BinaryProtocol.encode_reply = self._wrap(BinaryProtocol.encode_reply)
+        return self
+
+    def __exit__(self, *exc_info):
+        json.dumps, BinaryProtocol.encode_reply = self._originals
+
+
+async def run(client_count, notifications, binary, filtered):
+    server = WildServer(parent=None, my_firmata=NullCore())
+    subscribe = server.command_map["subscribe"]
+    params = ["analog", 0, {"deadband": 0}] if filtered else ["analog", 0]
+    for i in range(client_count):
+        session = ClientSession(NullConnection(), i + 1, binary=binary)
+        server.sessions.add(session)
+        await subscribe(session, params)
+
+    with EncodeCounter() as encodes:
+        start = time.process_time()
+        for i in range(notifications):
+            server.analog_callback([0, i & 0x3ff, Constants.ANALOG])
+            # let the writers send, as the event loop would between serial reads
+            await asyncio.sleep(0)
+        while any(session.queue_depth for session in server.sessions):
+            await asyncio.sleep(0)
+        elapsed = time.process_time() - start
+    frames = sum(session.websocket.frames for session in server.sessions)
+
+    for session in server.sessions:
+        session.close()
+    await asyncio.sleep(0)
+    return elapsed, frames / client_count, encodes.calls / notifications
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--notifications", type=int, default=20000, help="notifications per run")
+    parser.add_argument("--binary", action="store_true", help="clients use the binary subprotocol")
+    parser.add_argument("--unfiltered", action="store_true", help="subscribe without a SubscriptionFilter")
+    args = parser.parse_args()
+
+    print("{:>8} {:>12} {:>19} {:>15} {:>16}".format("clients", "us/notify", "us/notify/client",
+                                                      "frames/client", "encodes/notify"))
+    encode_rates = []
+    for client_count in (1, 2, 5, 10, 20, 50):
+        elapsed, frames, encodes = asyncio.run(run(client_count, args.notifications, args.binary,
+                                                   not args.unfiltered))
+        per_notification = elapsed / args.notifications * 1e6
+        print("{:>8} {:>12.2f} {:>19.2f} {:>15.0f} {:>16.2f}".format(client_count, per_notification,
+                                                                   per_notification / client_count, frames,
+                                                                   encodes))
+        encode_rates.append(encodes)
+
+    # the encoding cost per notification must not grow with the client count
+    assert all(encodes == 1 for encodes in encode_rates), \
+        "expected one encode per notification, got {}".format(encode_rates)
+    print("Encodes per notification stays at 1 from 1 to 50 clients")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+import pytest
+
+import Wildcards_BinaryProtocol as BinaryProtocol
+
+
+def test_decode_analog_write():
+    frame = bytes([BinaryProtocol.ANALOG_WRITE, 9, 0x34, 0x12])
+    assert BinaryProtocol.decode_command(frame) == ("analog_write", [9, 0x1234])
+
+
+def test_decode_digital_write():
+    frame = bytes([BinaryProtocol.DIGITAL_WRITE, 13, 1])
+    assert BinaryProtocol.decode_command(frame) == ("digital_write", [13, 1])
+
+
+@pytest.mark.parametrize("frame", [b"", bytes([0x7E, 1, 1]), bytes([BinaryProtocol.ANALOG_WRITE, 9, 1]),
+                                   bytes([BinaryProtocol.DIGITAL_WRITE, 13, 1, 0])])
+def test_decode_rejects_bad_frames(frame):
+    with pytest.raises(ValueError):
+        BinaryProtocol.decode_command(frame)
+
+
+def test_encode_replies():
+    assert BinaryProtocol.encode_reply("analog_message_reply", [2, 1023]) == \
+        bytes([BinaryProtocol.ANALOG_MESSAGE_REPLY, 2, 0xFF, 0x03])
+    assert BinaryProtocol.encode_reply("digital_message_reply", [7, 1]) == \
+        bytes([BinaryProtocol.DIGITAL_MESSAGE_REPLY, 7, 1])
+
+
+def test_encode_falls_back_to_json():
+    # no binary layout for the method
+    assert BinaryProtocol.encode_reply("sonar_data_reply", [7, 20]) is None
+    # value doesn't fit the layout
+    assert BinaryProtocol.encode_reply("analog_message_reply", [2, 70000]) is None
+    assert BinaryProtocol.encode_reply("digital_message_reply", [7, -1]) is None
@@ -0,0 +1,63 @@
+import json
+
+from Wildcards_BoardProfileCache import BoardProfileCache
+
+
+def store_uno(cache):
+    cache.store("COM3", "StandardFirmata.ino", [127, 127, 0, 1], [0x7F, 0x7F], [{"pin": 0}])
+
+
+def test_store_and_lookup(tmp_path):
+    cache = BoardProfileCache(str(tmp_path / "profiles.json"))
+    assert cache.lookup("COM3") is None
+    store_uno(cache)
+    profile = cache.lookup("COM3", "StandardFirmata.ino")
+    assert profile == {"firmware": "StandardFirmata.ino",
+                       "analog_map": [127, 127, 0, 1],
+                       "capability": [0x7F, 0x7F],
+                       "pins": [{"pin": 0}]}
+    # without a firmware ID, the one last seen on the port is used
+    assert cache.lookup("COM3") == profile
+    assert cache.lookup("COM4") is None
+
+
+def test_profiles_persist_across_instances(tmp_path):
+    path = tmp_path / "nested" / "profiles.json"
+    store_uno(BoardProfileCache(str(path)))
+    assert json.loads(path.read_text())["COM3"]["last"] == "StandardFirmata.ino"
+    assert BoardProfileCache(str(path)).lookup("COM3")["analog_map"] == [127, 127, 0, 1]
+
+
+def test_invalidate_forgets_the_profile(tmp_path):
+    cache = BoardProfileCache(str(tmp_path / "profiles.json"))
+    store_uno(cache)
+    cache.invalidate("COM3", "StandardFirmata.ino")
+    assert cache.lookup("COM3") is None
+    assert cache.lookup("COM3", "StandardFirmata.ino") is None
+    cache.invalidate("COM9", "missing")
+
+
+def test_unreadable_file_is_treated_as_empty(tmp_path):
+    path = tmp_path / "profiles.json"
+    path.write_text("not json")
+    cache = BoardProfileCache(str(path))
+    assert cache.lookup("COM3") is None
+    store_uno(cache)
+    assert BoardProfileCache(str(path)).lookup("COM3") is not None
+
+
+def test_swapped_board_with_the_same_sketch_does_not_match(tmp_path):
+    cache = BoardProfileCache(str(tmp_path / "profiles.json"))
+    uno_map = [127] * 14 + [0, 1, 2, 3, 4, 5]
+    mega_map = [127] * 54 + list(range(16))
+    cache.store("COM3", "2.5 StandardFirmata.ino", uno_map, [0x7F], [{"pin": 0}])
+    profile = cache.lookup("COM3")
+    assert cache.matches(profile, "2.5 StandardFirmata.ino", uno_map)
+    # a Mega running the same sketch reports the same firmware ID
+    assert not cache.matches(profile, "2.5 StandardFirmata.ino", mega_map)
+    assert not cache.matches(profile, "2.5 StandardFirmata.ino", None)
+    assert not cache.matches(profile, "2.4 StandardFirmata.ino", uno_map)
+    # the link then drops the profile and stores the one it discovers
+    cache.invalidate("COM3", "2.5 StandardFirmata.ino")
+    cache.store("COM3", "2.5 StandardFirmata.ino", mega_map, [0x7F], [{"pin": 0}])
+    assert cache.matches(cache.lookup("COM3"), "2.5 StandardFirmata.ino", mega_map)
@@ -0,0 +1,53 @@
+from private_constants import PrivateConstants
+from Wildcards_FirmataParser import FirmataParser
+
+
+def test_analog_and_digital_messages():
+    parser = FirmataParser()
+    messages = parser.feed(bytes([0xE3, 0x10, 0x02, 0x91, 0x7F, 0x01]))
+    assert messages == [(PrivateConstants.ANALOG_MESSAGE, [3, 0x10, 0x02]),
+                        (PrivateConstants.DIGITAL_MESSAGE, [1, 0x7F, 0x01])]
+
+
+def test_report_version():
+    parser = FirmataParser()
+    assert parser.feed(bytes([0xF9, 2, 5])) == [(PrivateConstants.REPORT_VERSION, [2, 5])]
+
+
+def test_sysex_keeps_its_command_and_end_byte():
+    parser = FirmataParser()
+    messages = parser.feed(bytes([0xF0, 0x79, 2, 5, 0x41, 0xF7]))
+    assert messages == [(0x79, [0x79, 2, 5, 0x41, 0xF7])]
+
+
+def test_messages_split_across_chunks():
+    parser = FirmataParser()
+    data = bytes([0xE0, 0x01, 0x02, 0xF0, 0x6A, 1, 2, 3, 0xF7, 0x90, 0x05, 0x00])
+    messages = []
+    for i in range(len(data)):
+        messages.extend(parser.feed(data[i:i + 1]))
+    assert messages == [(PrivateConstants.ANALOG_MESSAGE, [0, 1, 2]),
+                        (0x6A, [0x6A, 1, 2, 3, 0xF7]),
+                        (PrivateConstants.DIGITAL_MESSAGE, [0, 5, 0])]
+
+
+def test_resynchronizes_after_stray_and_truncated_bytes():
+    parser = FirmataParser()
+    # a stray data byte, then an analog message cut short by a digital one
+    messages = parser.feed(bytes([0x05, 0xE2, 0x01, 0x91, 0x02, 0x03]))
+    assert messages == [(PrivateConstants.DIGITAL_MESSAGE, [1, 2, 3])]
+    assert parser.discarded_bytes == 3
+
+
+def test_oversized_sysex_is_discarded():
+    parser = FirmataParser(max_sysex_size=8)
+    assert parser.feed(bytes([0xF0]) + bytes(range(1, 20))) == []
+    assert parser.discarded_bytes == 20
+    assert parser.feed(bytes([0xF9, 2, 5])) == [(PrivateConstants.REPORT_VERSION, [2, 5])]
+
+
+def test_reset_drops_a_partial_message():
+    parser = FirmataParser()
+    assert parser.feed(bytes([0xE0, 0x01])) == []
+    parser.reset()
+    assert parser.feed(bytes([0x02, 0xF9, 2, 5])) == [(PrivateConstants.REPORT_VERSION, [2, 5])]
@@ -0,0 +1,87 @@
+import asyncio
+
+import pytest
+
+from Wildcards_Metrics import MetricsRegistry, MetricsServer
+
+
+def test_counter_and_gauge_exposition():
+    registry = MetricsRegistry()
+    counter = registry.counter("test_writes_total", "Writes")
+    gauge = registry.gauge("test_depth", "Depth")
+    counter.inc()
+    counter.inc(2)
+    gauge.set(5)
+    gauge.dec()
+    assert registry.render() == ("# HELP test_depth Depth\n"
+                                 "# TYPE test_depth gauge\n"
+                                 "test_depth 4\n"
+                                 "# HELP test_writes_total Writes\n"
+                                 "# TYPE test_writes_total counter\n"
+                                 "test_writes_total 3\n")
+
+
+def test_labels_are_rendered_sorted_and_escaped():
+    registry = MetricsRegistry()
+    counter = registry.counter("test_messages_total", "Messages", ("method",))
+    counter.labels("b").inc()
+    counter.labels('a"\\').inc(2)
+    lines = registry.render().splitlines()
+    assert lines[2:] == ['test_messages_total{method="a\\"\\\\"} 2',
+                         'test_messages_total{method="b"} 1']
+    with pytest.raises(ValueError):
+        counter.labels("a", "b")
+
+
+def test_gauge_function_is_read_at_render_time():
+    registry = MetricsRegistry()
+    gauge = registry.gauge("test_connections", "Connections")
+    values = [1]
+    gauge.set_function(lambda: values[0])
+    values[0] = 7
+    assert "test_connections 7" in registry.render().splitlines()
+
+
+def test_histogram_buckets_are_cumulative():
+    registry = MetricsRegistry()
+    histogram = registry.histogram("test_seconds", "Time", buckets=(0.1, 1))
+    for value in (0.05, 0.1, 0.5, 3):
+        histogram.observe(value)
+    assert registry.render().splitlines()[2:] == ['test_seconds_bucket{le="0.1"} 2',
+                                                  'test_seconds_bucket{le="1"} 3',
+                                                  'test_seconds_bucket{le="+Inf"} 4',
+                                                  'test_seconds_sum 3.65',
+                                                  'test_seconds_count 4']
+
+
+def test_duplicate_names_are_rejected():
+    registry = MetricsRegistry()
+    registry.counter("test_total", "Test")
+    with pytest.raises(ValueError):
+        registry.gauge("test_total", "Test")
+
+
+def test_server_serves_metrics_and_404():
+    registry = MetricsRegistry()
+    registry.counter("test_total", "Test").inc()
+
+    async def get(port, path):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write("GET {} HTTP/1.1\r\nHost: localhost\r\n\r\n".format(path).encode("latin-1"))
+        response = await reader.read()
+        writer.close()
+        return response.decode("utf-8")
+
+    async def run():
+        server = MetricsServer(port=0, registry=registry)
+        await server.start()
+        port = server._server.sockets[0].getsockname()[1]
+        try:
+            return await get(port, "/metrics"), await get(port, "/other")
+        finally:
+            server.close()
+
+    metrics, other = asyncio.run(run())
+    assert metrics.startswith("HTTP/1.1 200 OK\r\n")
+    assert metrics.endswith("test_total 1\n")
+    assert other.startswith("HTTP/1.1 404 Not Found\r\n")
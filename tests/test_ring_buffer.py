@@ -0,0 +1,61 @@
+import pytest
+
+from Wildcards_RingBuffer import RingBuffer
+
+
+def test_read_returns_bytes_in_order():
+    buffer = RingBuffer(8)
+    buffer.extend(b"abc")
+    buffer.extend(bytearray(b"de"))
+    assert len(buffer) == 5
+    assert buffer.read(2) == b"ab"
+    assert buffer.read() == b"cde"
+    assert len(buffer) == 0
+    assert buffer.read() == b""
+
+
+def test_pop_and_empty_pop():
+    buffer = RingBuffer(4)
+    buffer.extend(b"\x90\x01")
+    assert buffer.pop() == 0x90
+    assert buffer.pop() == 0x01
+    with pytest.raises(IndexError):
+        buffer.pop()
+
+
+def test_wraps_around_the_end_of_the_storage():
+    buffer = RingBuffer(5)
+    buffer.extend(b"abcd")
+    assert buffer.read(3) == b"abc"
+    buffer.extend(b"efgh")
+    assert buffer.read() == b"defgh"
+
+
+def test_overflow_drops_the_oldest_bytes():
+    buffer = RingBuffer(4)
+    buffer.extend(b"abc")
+    assert buffer.extend(b"de") == 1
+    assert buffer.dropped_bytes == 1
+    assert buffer.read() == b"bcde"
+
+
+def test_write_larger_than_capacity_keeps_the_newest_bytes():
+    buffer = RingBuffer(4)
+    buffer.extend(b"xy")
+    assert buffer.extend(b"abcdef") == 4
+    assert buffer.dropped_bytes == 4
+    assert buffer.read() == b"cdef"
+
+
+def test_clear_discards_unread_bytes():
+    buffer = RingBuffer(4)
+    buffer.extend(b"abc")
+    buffer.clear()
+    assert len(buffer) == 0
+    buffer.extend(b"z")
+    assert buffer.read() == b"z"
+
+
+def test_capacity_must_be_positive():
+    with pytest.raises(ValueError):
+        RingBuffer(0)
@@ -0,0 +1,99 @@
+import asyncio
+import json
+
+import pytest
+
+# Wildcards_Server needs the websocket and serial libraries
+pytest.importorskip("websockets")
+pytest.importorskip("serial")
+
+from Wildcards_Server import WildServer
+
+
+class FakeCore:
+    """
+    The parts of WildcardsFirmata the tested commands use. Pin state queries
+    never get an answer, like a board that ignores them.
+    """
+
+    def __init__(self):
+        self.written = []
+        self.pin_state_queries = 0
+        self.holds = 0
+        self._flush_hooks = []
+
+    def add_pre_flush_hook(self, hook):
+        self._flush_hooks.append(hook)
+
+    def request_flush(self):
+        # write_continuously would run the hooks on its next frame
+        for hook in self._flush_hooks:
+            hook()
+
+    def output_pending(self):
+        return False
+
+    def hold_output(self):
+        self.holds += 1
+
+    def release_output(self):
+        self.holds -= 1
+
+    def digital_write(self, pin, value):
+        self.written.append((pin, value))
+
+    async def get_pin_state(self, pin):
+        self.pin_state_queries += 1
+        await asyncio.Event().wait()
+
+
+class FakeWebsocket:
+    subprotocol = None
+
+    def __init__(self, commands):
+        self._incoming = [json.dumps(command) for command in commands]
+        self.sent = []
+
+    async def recv(self):
+        if self._incoming:
+            return self._incoming.pop(0)
+        # the client stays connected but sends nothing more
+        await asyncio.Event().wait()
+
+    async def send(self, message):
+        self.sent.append(message)
+
+
+def run_commands(commands):
+    core = FakeCore()
+
+    async def run():
+        server = WildServer(parent=None, my_firmata=core)
+        connection = asyncio.ensure_future(server.get_message(FakeWebsocket(commands), "/"))
+        await asyncio.sleep(0.1)
+        connection.cancel()
+        await asyncio.gather(connection, return_exceptions=True)
+
+    asyncio.run(run())
+    return core
+
+
+def test_query_commands_are_client_method_names():
+    server = WildServer(parent=None, my_firmata=FakeCore())
+    assert WildServer.QUERY_COMMANDS <= server.command_map.keys()
+
+
+def test_unanswered_pin_state_query_does_not_hold_up_later_writes():
+    core = run_commands([{"method": "get_pin_state", "params": [13]},
+                         {"method": "digital_write", "params": [13, 1]}])
+    assert core.pin_state_queries == 1
+    assert core.written == [(13, 1)]
+
+
+def test_batch_skips_queries_and_releases_output():
+    core = run_commands([{"method": "batch", "params": [{"method": "get_pin_state", "params": [13]},
+                                                        {"method": "digital_write", "params": [13, 1]}]}])
+    # a query inside a batch would keep output held until the board answered
+    assert core.pin_state_queries == 0
+    assert core.written == [(13, 1)]
+    assert core.holds == 0
@@ -0,0 +1,86 @@
+import asyncio
+
+import pytest
+
+# Wildcards_ClientSession imports websockets for the session writer
+pytest.importorskip("websockets")
+
+from Wildcards_ClientSession import SubscriptionFilter
+
+
+def never_released(method, params):
+    raise AssertionError("nothing should be held back")
+
+
+def test_without_options_every_change_is_sent():
+    sub_filter = SubscriptionFilter(never_released)
+    assert sub_filter.offer("analog_message_reply", [0, 10], 0.0)
+    assert sub_filter.offer("analog_message_reply", [0, 11], 0.0)
+
+
+def test_absolute_deadband():
+    sub_filter = SubscriptionFilter(never_released, deadband=5)
+    assert sub_filter.offer("analog_message_reply", [0, 100], 0.0)
+    assert not sub_filter.offer("analog_message_reply", [0, 105], 1.0)
+    assert not sub_filter.offer("analog_message_reply", [0, 96], 2.0)
+    assert sub_filter.offer("analog_message_reply", [0, 106], 3.0)
+
+
+def test_percent_deadband_is_relative_to_the_last_value_sent():
+    sub_filter = SubscriptionFilter(never_released, deadband_percent=10)
+    assert sub_filter.offer("analog_message_reply", [0, 200], 0.0)
+    assert not sub_filter.offer("analog_message_reply", [0, 220], 1.0)
+    assert sub_filter.offer("analog_message_reply", [0, 221], 2.0)
+
+
+def test_non_numeric_values_only_filter_repeats():
+    sub_filter = SubscriptionFilter(never_released, deadband=5)
+    assert sub_filter.offer("i2c_read_data_reply", "abc", 0.0)
+    assert not sub_filter.offer("i2c_read_data_reply", "abc", 1.0)
+    assert sub_filter.offer("i2c_read_data_reply", "abd", 2.0)
+
+
+def test_rate_limit_holds_and_releases_the_latest_update():
+    released = []
+
+    async def run():
+        sub_filter = SubscriptionFilter(lambda method, params: released.append(params), max_rate=20)
+        loop = asyncio.get_event_loop()
+        assert sub_filter.offer("analog_message_reply", [0, 1], loop.time())
+        assert not sub_filter.offer("analog_message_reply", [0, 2], loop.time())
+        assert not sub_filter.offer("analog_message_reply", [0, 3], loop.time())
+        await asyncio.sleep(0.1)
+
+    asyncio.run(run())
+    assert released == [[0, 3]]
+
+
+def test_update_back_inside_the_deadband_cancels_the_held_one():
+    released = []
+
+    async def run():
+        sub_filter = SubscriptionFilter(lambda method, params: released.append(params),
+                                        max_rate=20, deadband=5)
+        loop = asyncio.get_event_loop()
+        assert sub_filter.offer("analog_message_reply", [0, 100], loop.time())
+        assert not sub_filter.offer("analog_message_reply", [0, 120], loop.time())
+        assert not sub_filter.offer("analog_message_reply", [0, 101], loop.time())
+        await asyncio.sleep(0.1)
+
+    asyncio.run(run())
+    assert released == []
+
+
+def test_cancel_drops_the_held_update():
+    released = []
+
+    async def run():
+        sub_filter = SubscriptionFilter(lambda method, params: released.append(params), max_rate=20)
+        loop = asyncio.get_event_loop()
+        sub_filter.offer("analog_message_reply", [0, 1], loop.time())
+        sub_filter.offer("analog_message_reply", [0, 2], loop.time())
+        sub_filter.cancel()
+        await asyncio.sleep(0.1)
+
+    asyncio.run(run())
+    assert released == []